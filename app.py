@@ -4,8 +4,9 @@ from clock_mode import ClockMode
 import display
 from edit_mode import EditMode
 import fs
-import gc
+import memory
 from menu_mode import MenuMode
+import prefs
 import utils
 
 
@@ -37,14 +38,18 @@ class App:
         self.mode.start()
 
     def step(self):
+        memory.start_frame()
         level = self.battery_sensor.level
         if level is not None and level < 2:
             display.blank()
+            prefs.flush()
             utils.shut_down(self.battery_sensor)
         self.frame_counter.tick()
         cctime.rtc_sync()
         self.brightness_reader.step(self)
         self.mode.step()
+        prefs.step()
+        memory.end_frame()
 
     def receive(self, command, arg=None):
         print('[' + command + ('' if arg is None else ': ' + str(arg)) + ']')
@@ -81,12 +86,13 @@ class App:
             for i in range(192*32):
                 print(rgbs[self.bitmap[i]], end='')
             print('\n[[FRAME]]')
-            gc.collect()
+            memory.collect()
 
         self.mode.receive(command, arg)
 
     def set_mode(self, mode):
         self.bitmap.fill(0)
+        display.release(self.mode, erased=True)
         self.mode = mode
         mode.start()
 
@@ -109,6 +115,7 @@ class FrameCounter:
             print('|\n', end='')
             if now_sec % 10 == 0:
                 utils.log(f'Up {self.uptime()} s ({self.fps:.1f} fps) on {utils.version_dir()}')
+                utils.log(f'Memory: {memory.get_stats()}')
         print('.', end='')
         self.last_tick = now
 
@@ -132,6 +139,7 @@ class Indicator:
         self.depth -= 1
         if self.depth == 0:
             self.bitmap.fill(0, 191, 0, 192, 1)
+            display.damage(191, 0, 192, 1)
 
 
 def run(bitmap, net, battery_sensor, button_map, dial_map):
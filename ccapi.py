@@ -1,23 +1,30 @@
-"""Client for the Climate Clock API.  Main entry point is load().
+"""Client for the Climate Clock API.  Main entry points are load() and Loader.
 
 See: https://docs.climateclock.world/climate-clock-docs/climate-clock-api
 """
 
+from array import array
 import cctime
-import gc
-import json
+import fs
+import jsonstream
+import microfont
 from collections import namedtuple
+import struct
 
 
 Config = namedtuple('Config', ('device_id', 'module_ids', 'display', 'langs'))
 Display = namedtuple('Display', ('deadline', 'lifeline', 'timer'))
 Palette = namedtuple('Palette', ('primary',))
-Item = namedtuple('Item', ('pub_millis', 'headline', 'source'))
+Item = namedtuple('Item', ('pub_millis', 'headline', 'source', 'glyphs', 'width'))
 Timer = namedtuple('Timer', ('id', 'type', 'flavor', 'unit_labels', 'labels', 'full_width_labels', 'ref_millis'))
 Newsfeed = namedtuple('Newsfeed', ('id', 'type', 'flavor', 'labels', 'full_width_labels', 'items'))
 Value = namedtuple('Value', ('id', 'type', 'flavor', 'labels', 'full_width_labels', 'initial', 'ref_millis', 'growth', 'rate', 'decimals', 'shift', 'bias', 'unit_labels', 'count_up_millis'))
 Defn = namedtuple('Defn', ('config', 'module_dict', 'modules'))
 
+# To keep the display running while a definition loads, Loader reads and
+# parses the file this many bytes at a time.
+LOAD_CHUNK_LENGTH = 512
+
 # Remove this when the API file is updated to include language names.
 LANGUAGE_NAMES = {
     'de': 'Deutsch',
@@ -29,7 +36,6 @@ LANGUAGE_NAMES = {
 
 
 def load_config(data):
-    gc.collect()
     langs = data.get('langs', {'en': 'English'})
     if isinstance(langs, list):
         langs = {code: LANGUAGE_NAMES.get(code, code) for code in langs}
@@ -42,7 +48,6 @@ def load_config(data):
 
 
 def load_display(data):
-    gc.collect()
     return Display(
         load_palette(data.get('deadline') or {}),
         load_palette(data.get('lifeline') or {}),
@@ -51,21 +56,18 @@ def load_display(data):
 
 
 def load_palette(data):
-    gc.collect()
     return Palette(
         parse_css_color(data.get('color_primary') or None)
     )
 
 
 def parse_css_color(color):
-    gc.collect()
     color = (color or '').replace('#', '')
     if len(color) == 6:
         return int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)
 
 
 def load_timer(id, data, timer_config):
-    gc.collect()
     return Timer(
         id,
         data.get('type'),
@@ -77,27 +79,89 @@ def load_timer(id, data, timer_config):
     )
 
 
-def load_newsfeed(id, data):
-    gc.collect()
+def load_newsfeed(id, data, items):
     return Newsfeed(
         id,
         data.get('type'),
         data.get('flavor'),
         data.get('labels'),
         data.get('full_width_labels'),
-        [load_item(item) for item in data.get('newsfeed', [])]
+        items
     )
 
 
 def load_item(data):
-    gc.collect()
-    return Item(
+    return make_item(
         cctime.try_isoformat_to_millis(data, 'date'),
         data.get('headline') or '',
         data.get('source') or '',
     )
 
 
+# Newsfeed items can be kept in a file instead of in memory.  Each item is
+# stored as its publication time (or NO_MILLIS if it has none), the lengths
+# of its headline and source, and then the UTF-8 text of both.
+ITEM_HEADER = '<qHH'
+NO_MILLIS = -1
+
+
+def get_items_path(path):
+    return path + '.items'
+
+
+def write_item(file, data):
+    pub_millis = cctime.try_isoformat_to_millis(data, 'date')
+    headline = (data.get('headline') or '').encode()
+    source = (data.get('source') or '').encode()
+    file.write(struct.pack(
+        ITEM_HEADER, NO_MILLIS if pub_millis is None else pub_millis,
+        len(headline), len(source)))
+    file.write(headline)
+    file.write(source)
+    return struct.calcsize(ITEM_HEADER) + len(headline) + len(source)
+
+
+class ItemStore:
+    """A list of newsfeed items stored in a file.  The newsfeed only needs
+    the current and next items at any time, so only the last two items
+    requested are kept in memory."""
+
+    def __init__(self, path, offsets):
+        self.path = path
+        self.offsets = offsets  # position of each item in the file
+        self.cache = []  # up to two (index, Item) pairs
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        for cached_index, item in self.cache:
+            if cached_index == index:
+                return item
+        with fs.open(self.path) as file:
+            file.seek(self.offsets[index])
+            header = file.read(struct.calcsize(ITEM_HEADER))
+            pub_millis, headline_length, source_length = struct.unpack(
+                ITEM_HEADER, header)
+            headline = str(file.read(headline_length), 'utf-8')
+            source = str(file.read(source_length), 'utf-8')
+        item = make_item(
+            None if pub_millis == NO_MILLIS else pub_millis, headline, source)
+        self.cache = self.cache[-1:] + [(index, item)]
+        return item
+
+
+def make_item(pub_millis, headline, source):
+    # Formats the item for display and encodes it as glyph indexes in the
+    # large font once, so the newsfeed doesn't have to on every frame.
+    text = headline.strip()
+    if source:
+        text += f' ({source.strip()})'
+    font = microfont.large
+    glyphs = font.encode(text)
+    return Item(pub_millis, headline, source, glyphs, font.measure_glyphs(glyphs))
+
+
 def load_value(id, data):
     decimals = data.get('decimals')
     if decimals is None:
@@ -155,26 +219,115 @@ def load_value(id, data):
     )
 
 
-def load_defn(data):
-    gc.collect()
-    config = load_config(data.get('config', {}))
-    gc.collect()
-    module_dict = {}
-    for module_id, value in data.get('modules', {}).items():
-        if value['type'] == 'timer':
-            module = load_timer(module_id, value, config.display.timer)
-        elif value['type'] == 'newsfeed':
-            module = load_newsfeed(module_id, value)
-        elif value['type'] == 'value':
+class Loader:
+    """Builds a Defn from the JSON text of an API response, which can be fed
+    to it in pieces.  Each module and newsfeed item is built as soon as it
+    has been parsed, so the whole parsed document is never held in memory.
+    If items_path is given, newsfeed items are written to that file and
+    read back as needed, instead of being kept in memory.  The items are
+    written to temp_path while loading, which must not be in use by any
+    other Loader."""
+
+    def __init__(self, file=None, items_path=None, temp_path=None):
+        self.file = file
+        self.items_path = items_path
+        self.temp_path = temp_path
+        self.items_file = None
+        if items_path:
+            self.items_file = fs.open(temp_path, 'wb')
+            self.items_length = 0
+        self.chunk = bytearray(LOAD_CHUNK_LENGTH)
+        self.parser = jsonstream.Parser(self.handle)
+        self.config = None
+        self.module_dict = {}
+        self.pending_modules = []  # modules that arrived before the config
+        self.items = self.new_items()  # items of the module being parsed
+
+    def step(self):
+        """Parses the next piece of the file; returns the Defn when done."""
+        count = self.file.readinto(self.chunk)
+        if count:
+            self.feed(memoryview(self.chunk)[:count])
+        else:
+            return self.finish()
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def finish(self):
+        if 'data' not in self.parser.finish():
+            raise ValueError('API response has no data')
+        self.config = self.config or load_config({})
+        for module_id, value, items in self.pending_modules:
+            self.add_module(module_id, value, items)
+        defn = Defn(
+            self.config,
+            self.module_dict,
+            [self.module_dict[module_id] for module_id in self.config[1]
+             if module_id in self.module_dict]
+        )
+        # The definition being displayed may be reading items from the file
+        # at items_path, so it is replaced only once nothing else can fail.
+        if self.items_file:
+            self.items_file.close()
+            self.items_file = None
+            fs.move(self.temp_path, self.items_path)
+        return defn
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        if self.items_file:
+            self.items_file.close()
+
+    def new_items(self):
+        return array('L') if self.items_path else []
+
+    def handle(self, path, value):
+        depth = len(path)
+        if depth < 2 or path[0] != 'data':
+            return False
+        if path[1] == 'config' and depth == 2:
+            self.config = load_config(value)
+            return True
+        if path[1] == 'modules':
+            if depth == 5 and path[3] == 'newsfeed':
+                if self.items_file:
+                    self.items.append(self.items_length)
+                    self.items_length += write_item(self.items_file, value)
+                else:
+                    self.items.append(load_item(value))
+                return True
+            if depth == 3:
+                items, self.items = self.items, self.new_items()
+                if self.config:
+                    self.add_module(path[2], value, items)
+                else:
+                    self.pending_modules.append((path[2], value, items))
+                return True
+        return False
+
+    def add_module(self, module_id, value, items):
+        module_type = value.get('type')
+        if module_type == 'timer':
+            module = load_timer(module_id, value, self.config.display.timer)
+        elif module_type == 'newsfeed':
+            if self.items_path:
+                items = ItemStore(self.items_path, items)
+            module = load_newsfeed(module_id, value, items)
+        elif module_type == 'value':
             module = load_value(module_id, value)
-        gc.collect()
-        module_dict[module_id] = module
-    return Defn(
-        config,
-        module_dict,
-        [module_dict[module_id] for module_id in config[1]]
-    )
+        else:
+            # Newer module types may be added to the API; skip them rather
+            # than rejecting the whole definition.
+            print(f'Skipping module {module_id} of unknown type {module_type}')
+            return
+        self.module_dict[module_id] = module
 
 
 def load(file):
-    return load_defn(json.load(file)['data'])
+    loader = Loader(file)
+    while True:
+        defn = loader.step()
+        if defn:
+            return defn
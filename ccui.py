@@ -1,6 +1,8 @@
 """Functions for formatting and constructing the Climate Clock display."""
 
+from array import array
 import cctime
+import display
 from displayio import Bitmap
 import math
 from microfont import large, small
@@ -10,59 +12,319 @@ import time
 
 DISPLAY_WIDTH = 192
 
+# For each 16-pixel band of the display (keyed by y), a key describing what
+# was last drawn there, so that renderers can skip bands that haven't changed.
+band_keys = {}
 
-def calc_countdown(deadline_module, now_millis):
+# Fonts to try for a label shown on its own, from most to least preferred,
+# each with the vertical offset that centres it in a 16-pixel band.
+LABEL_FONTS = [(large, 0), (small, 2)]
+
+# Fonts to try for the value of a value module, from most to least preferred,
+# each with the vertical offset that puts it on the band's baseline (e.g.
+# (small, 5) could be added as a fallback).  The value's label is always drawn
+# in the small font on the same baseline.
+VALUE_FONTS = [(large, 0)]
+
+# Layout decisions (which label, unit, and font fit, and where), keyed by the
+# labels or by the module and width of the value being shown, so that text is
+# only measured and fitted when something changes size.  Cleared by
+# reset_layouts() whenever a new definition is loaded.
+layouts = {}
+
+
+# The next anniversary of the deadline stays the same for a whole year, so
+# render_timer_module keeps it here instead of recomputing it on every frame.
+timer_module = None
+timer_anniversary_millis = 0
+timer_years = 0
+timer_seconds = None
+timer_key = None
+
+# The deadline_force_caps pref, kept up to date by set_timer_force_caps.
+timer_force_caps = False
+
+
+def set_timer_force_caps(value):
+    global timer_force_caps
+    global timer_seconds
+    timer_force_caps = bool(value)
+    timer_seconds = None  # redraw with the new capitalization
+
+
+prefs.subscribe('deadline_force_caps', set_timer_force_caps)
+
+YEAR_MS = 366 * 24 * 3600 * 1000
+
+
+def calc_anniversary(deadline_module, now_millis):
+    # Returns the time of the next anniversary of the deadline (which remains
+    # current until a second after it passes) and the whole number of years
+    # from that anniversary to the deadline.
     deadline = cctime.millis_to_tm(deadline_module.ref_millis)
     now = cctime.millis_to_tm(now_millis)
     next_anniversary = (now[0],) + deadline[1:]
     if next_anniversary < now:
         next_anniversary = (now[0] + 1,) + deadline[1:]
     y = deadline[0] - next_anniversary[0]
-    # When showing a countdown, round up to the next highest whole second.
-    t = (cctime.tm_to_millis(next_anniversary) - now_millis + 999)//1000
+    return cctime.tm_to_millis(next_anniversary), y
+
+
+def split_countdown(t):
+    # Splits a number of seconds into days, hours, minutes, and seconds.
     s, t = t % 60, t // 60
     m, t = t % 60, t // 60
     h, d = t % 24, t // 24
-    return y, d, h, m, s
+    return d, h, m, s
+
+
+def calc_countdown(deadline_module, now_millis):
+    anniversary_millis, y = calc_anniversary(deadline_module, now_millis)
+    # When showing a countdown, round up to the next highest whole second.
+    t = (anniversary_millis - now_millis + 999)//1000
+    return (y,) + split_countdown(t)
 
 
 def format_decimal(value, bias, shift, decimals):
-    value += -bias if value < 0 else bias  # proper rounding
-    str_value = '0'*shift + str(abs(value))
-    negative_sign = '-' if value < 0 else ''
-    whole_part = str_value[:-shift].lstrip('0')
     # ccapi.load_value guarantees that shift > decimals.
-    fractional_part = str_value[-shift:][:decimals]
-
-    result = negative_sign + whole_part
-    if fractional_part:
-        result += '.' + fractional_part
-    return result
-
-
-def format_value(module, now_millis, start_millis=0):
-    result = ''
-    elapsed = now_millis - module.ref_millis  # integer
-    if module.growth == 'linear':
-        value = module.initial + module.rate * elapsed // 1000
-        result = format_decimal(
-            value, module.bias, module.shift, module.decimals)
-    if module.count_up_millis:
-        length = len(result)
-        if now_millis - start_millis < module.count_up_millis:
-            t = (now_millis - start_millis) * 1000 // module.count_up_millis
-            progress = 1000000000 - (1000 - t) * (1000 - t) * (1000 - t)
-            elapsed = elapsed * progress // 1000000000
-            value = module.initial + module.rate * elapsed // 1000
-            result = format_decimal(
-                value, module.bias, module.shift, module.decimals)
-            result = '\u2007' * (length - len(result)) + result
-    return result
+    negative_sign = '-' if value < 0 else ''
+    unit = 10**(shift - decimals)
+    return format_digits(negative_sign, (abs(value) + bias)//unit, decimals)
+
+
+def format_digits(negative_sign, digits, decimals):
+    # Formats an integer number of units of the last decimal place.
+    digits = str(digits)
+    if not decimals:
+        return negative_sign + digits.lstrip('0')
+    digits = '0'*(decimals + 1 - len(digits)) + digits
+    return (negative_sign + digits[:-decimals].lstrip('0') + '.' +
+        digits[-decimals:])
+
+
+class ValueTicker:
+    # Keeps the formatted text of a value module, recomputing it only when
+    # the displayed digits are due to change.  For a linear value, we can
+    # work out how long the current text will last, so on most frames no
+    # bigint arithmetic or string formatting is needed at all.
+
+    def __init__(self, module):
+        self.module = module
+        self.unit = 10**(module.shift - module.decimals)
+        self.text = ''
+        self.valid_from = self.valid_until = 0  # elapsed times in ms
+
+    def get_text(self, now_millis, start_millis=0):
+        m = self.module
+        elapsed = now_millis - m.ref_millis  # integer
+        if (m.growth == 'linear' and
+            not self.valid_from <= elapsed < self.valid_until):
+            self.update(elapsed)
+        if m.count_up_millis and now_millis - start_millis < m.count_up_millis:
+            t = (now_millis - start_millis) * 1000 // m.count_up_millis
+            elapsed = elapsed * get_easing(t) // 1000000000
+            value = m.initial + m.rate * elapsed // 1000
+            result = format_decimal(value, m.bias, m.shift, m.decimals)
+            return '\u2007' * (len(self.text) - len(result)) + result
+        return self.text
+
+    def update(self, elapsed):
+        m, unit = self.module, self.unit
+        value = m.initial + m.rate * elapsed // 1000
+        negative = value < 0
+        digits = (abs(value) + m.bias)//unit
+        self.text = format_digits(negative and '-' or '', digits, m.decimals)
+        self.valid_from = elapsed
+
+        # Find the next value at which the text changes (the next rounding
+        # boundary or change of sign), then the time the value reaches it.
+        if m.rate > 0:
+            if negative:
+                boundary = min(m.bias - digits*unit + 1, 0)
+            else:
+                boundary = (digits + 1)*unit - m.bias
+            self.valid_until = -((m.initial - boundary)*1000//m.rate)
+        elif m.rate < 0:
+            if negative:
+                boundary = m.bias - (digits + 1)*unit
+            else:
+                boundary = max(digits*unit - m.bias - 1, -1)
+            self.valid_until = (boundary - m.initial + 1)*1000//m.rate + 1
+        else:
+            self.valid_until = elapsed + YEAR_MS
+        self.valid_until = max(self.valid_until, elapsed + 1)
+
+
+# A table of the count-up easing curve, 1 - (1 - t)**3 (scaled by 10**9),
+# sampled at every EASING_STEP thousandths of t.
+EASING_STEP = 10
+easing_table = None
+
+
+def get_easing(t):
+    # Gets the count-up progress (from 0 to 10**9) at t thousandths of the way
+    # through the count-up, by linear interpolation in easing_table.
+    global easing_table
+    if not easing_table:
+        easing_table = array('L', [
+            1000000000 - (1000 - t) * (1000 - t) * (1000 - t)
+            for t in range(0, 1000 + EASING_STEP, EASING_STEP)
+        ])
+    i, f = t // EASING_STEP, t % EASING_STEP
+    if f:
+        a, b = easing_table[i], easing_table[i + 1]
+        return a + (b - a) * f // EASING_STEP
+    return easing_table[i]
+
+
+def invalidate(y=None):
+    # Forgets what was drawn in the band at y (or all bands), so that it will
+    # be completely redrawn.  Call this after drawing over the bitmap directly.
+    if y is None:
+        band_keys.clear()
+        display.damage()
+    else:
+        band_keys.pop(y, None)
+
+
+def begin_band(bitmap, y, key):
+    # If the band at y already shows what key describes, returns False.
+    # Otherwise, clears and damages the band and returns True; the caller
+    # should then draw the band.  A key of None always causes a redraw.
+    if key is not None and band_keys.get(y) == key:
+        return False
+    band_keys[y] = key
+    bitmap.fill(0, 0, y, bitmap.width, y + 16)
+    display.damage(0, y, bitmap.width, y + 16)
+    return True
+
+
+def redraw_cells(font, old_text, text, bitmap, x, y, pi):
+    # Given that old_text is drawn at (x, y), redraws only the glyph cells
+    # where text differs from it.  If the two don't line up cell for cell,
+    # returns False without drawing anything.
+    n = len(text)
+    if len(old_text) != n:
+        return False
+    get_index, cws = font.get_index, font.cws
+    changed = False
+    for i in range(n):
+        if text[i] != old_text[i]:
+            old_gi, gi = get_index(old_text[i]), get_index(text[i])
+            if cws[old_gi] != cws[gi]:
+                return False
+            if not (font.fits(old_gi) and font.fits(gi)):
+                return False
+            changed = True
+    if not changed:
+        return True
+
+    h = font.h
+    for i in range(n):
+        gi = get_index(text[i])
+        w = cws[gi]
+        if text[i] != old_text[i]:
+            bitmap.fill(0, x, y, x + w, y + h)
+            font.draw_glyph(gi, bitmap, x, y, pi)
+            display.damage(x, y, x + w, y + h)
+        x += w
+    return True
+
+
+def draw_line(bitmap, y, font, text, pi, label='', dy=0, x=None):
+    # Draws a line of text, followed by a small label, in the band at y (at
+    # x, or centred if x is None), and returns the band's new key.  If the
+    # band was last drawn by draw_line in the same font and colour with the
+    # same label, only the glyph cells of the text that changed are redrawn.
+    last_key = band_keys.get(y)
+    key = (font, text, pi, label)
+    if last_key == key:
+        band_keys[y] = key
+        return key
+    if x is None:
+        width = font.measure(text)
+        if label:
+            width += 4 + small.measure(label)
+        x = max((DISPLAY_WIDTH - width)//2, 0)
+    if (last_key and last_key[0] is font and last_key[2] == pi and
+        last_key[3] == label and
+        redraw_cells(font, last_key[1], text, bitmap, x, y + dy, pi)):
+        band_keys[y] = key
+        return key
+    begin_band(bitmap, y, key)
+    x = font.draw(text, bitmap, x, y + dy, pi)
+    small.draw(label, bitmap, x + 4, y + 5, pi)
+    return key
+
+
+def reset_layouts():
+    layouts.clear()
+
+
+def layout_label(labels):
+    # Returns the text, font, y-offset, and x-offset of the first label that
+    # fits in the first font it fits in, or None if none of them fit.
+    key = tuple(labels or ())
+    if key not in layouts:
+        layouts[key] = None
+        for text in labels or []:
+            for font, dy in LABEL_FONTS:
+                width = font.measure(text)
+                if width < DISPLAY_WIDTH:
+                    layouts[key] = text, font, dy, (DISPLAY_WIDTH - width)//2
+                    return layouts[key]
+    return layouts[key]
+
+
+def layout_value(module, value_text, with_label):
+    # Returns the font, y-offset, unit label, label, and x-offset for showing
+    # value_text, preferring earlier fonts, then earlier labels, then earlier
+    # unit labels.  The result depends only on the width of value_text, so
+    # it's computed once for each width.
+    key = (module.id, with_label, VALUE_FONTS[0][0].measure(value_text))
+    layout = layouts.get(key)
+    if not layout:
+        layout = layouts[key] = fit_value(module, value_text, with_label)
+    return layout
+
+
+def fit_value(module, value_text, with_label):
+    fallback = None
+    for font, dy in VALUE_FONTS:
+        label_text = unit_text = ''
+        label_w = value_w = 0
+        for label_item in module.labels:
+            if with_label:
+                label_text = label_item
+            label_w = small.measure(label_text)
+            for unit_text in module.unit_labels or ['']:
+                value_w = font.measure(value_text + unit_text)
+                if value_w + label_w < DISPLAY_WIDTH:
+                    return place_value(font, dy, unit_text, label_text, value_w)
+        if not fallback:
+            # If nothing fits, use the last labels in the preferred font.
+            value_w = font.measure(value_text + unit_text)
+            fallback = place_value(font, dy, unit_text, label_text, value_w)
+    return fallback
+
+
+def place_value(font, dy, unit_text, label_text, value_w):
+    width = value_w
+    if label_text:
+        width += 4 + small.measure(label_text)
+    return font, dy, unit_text, label_text, max((DISPLAY_WIDTH - width)//2, 0)
+
+
+# The state of render_value_module, so it can skip redrawing unchanged text.
+value_ticker = None
+value_key = None
+value_text = None
+value_pi = None
+value_with_label = None
 
 
 def render_module(
     bitmap, y, module, pi, with_label=True, start_millis=None):
-    bitmap.fill(0, 0, y, bitmap.width, y + 16)
     if module.type == 'timer':
         render_timer_module(bitmap, y, module, pi)
     if module.type == 'value':
@@ -72,63 +334,96 @@ def render_module(
 
 
 def render_timer_module(bitmap, y, module, pi):
-    yr, d, h, m, s = calc_countdown(module, cctime.get_millis())
+    global timer_module
+    global timer_anniversary_millis
+    global timer_years
+    global timer_seconds
+    global timer_key
+
+    now_millis = cctime.get_millis()
+    if (module is not timer_module or
+        now_millis >= timer_anniversary_millis + 1000 or
+        now_millis < timer_anniversary_millis - YEAR_MS):
+        timer_module = module
+        timer_anniversary_millis, timer_years = calc_anniversary(
+            module, now_millis)
+        timer_seconds = None
+
+    # When showing a countdown, round up to the next highest whole second.
+    # The text only changes when the second does.
+    t = (timer_anniversary_millis - now_millis + 999)//1000
+    band_key = band_keys.get(y)
+    if t == timer_seconds and band_key is timer_key and band_key[2] == pi:
+        return
+    timer_seconds = t
+
+    yr = timer_years
+    d, h, m, s = split_countdown(t)
     key = 'year' if yr == 1 else 'years'
     year_unit = (module.unit_labels.get(key) or [key])[0]
     key = 'day' if d == 1 else 'days'
     day_unit = (module.unit_labels.get(key) or [key])[0]
     text = f'{yr} {year_unit} {d} {day_unit} {h:02d}:{m:02d}:{s:02d}'
-    if prefs.get('deadline_force_caps'):
+    if timer_force_caps:
         text = text.upper()
-    width = large.measure(text)
-    x = max((DISPLAY_WIDTH - width)//2, 0)
-    large.draw(text, bitmap, x, y, pi)
+    timer_key = draw_line(bitmap, y, large, text, pi)
 
 
 def render_label(bitmap, y, labels, pi):
-    for text in labels or []:
-        for font, dy in (large, 0), (small, 2):
-            width = font.measure(text)
-            if width < bitmap.width:
-                x = (DISPLAY_WIDTH - width)//2
-                font.draw(text, bitmap, x, y + dy, pi)
-                return
+    layout = layout_label(labels)
+    if layout:
+        text, font, dy, x = layout
+        font.draw(text, bitmap, x, y + dy, pi)
 
 
 def render_value_module(
     bitmap, y, module, pi, with_label=True, start_millis=None):
-    value_text = format_value(module, cctime.get_millis(), start_millis)
-    label_text = unit_text = ''
-    label_w = value_w = 0
-    for label_item in module.labels:
-        if with_label:
-            label_text = label_item
-        label_w = small.measure(label_text)
-        for unit_text in module.unit_labels:
-            value_w = large.measure(value_text + unit_text)
-            if value_w + label_w < bitmap.width:
-                break
-        if value_w + label_w < bitmap.width:
-            break
+    global value_ticker
+    global value_key
+    global value_text
+    global value_pi
+    global value_with_label
+
+    if not value_ticker or value_ticker.module is not module:
+        value_ticker = ValueTicker(module)
+    text = value_ticker.get_text(cctime.get_millis(), start_millis)
+    if (text is value_text and band_keys.get(y) is value_key and
+        pi == value_pi and with_label == value_with_label):
+        return
+    value_text, value_pi, value_with_label = text, pi, with_label
+
+    font, dy, unit_text, label_text, x = layout_value(
+        module, value_text, with_label)
     text = value_text + unit_text
     if unit_text.startswith('$'):
         text = '$' + value_text + unit_text[1:]
-    width = large.measure(text)
-    if label_text:
-        width += 4 + small.measure(label_text)
-    x = max((DISPLAY_WIDTH - width)//2, 0)
-    x = large.draw(text, bitmap, x, y, pi)
-    small.draw(label_text, bitmap, x + 4, y + 5, pi)
+    value_key = draw_line(bitmap, y, font, text, pi, label_text, dy, x)
 
 
+# The newsfeed scrolls through newsfeed_buffer as a ring buffer: the left edge
+# of the display is at column newsfeed_x, and the next glyph is drawn
+# newsfeed_w pixels to the right of that (wrapping around the end).
 last_newsfeed_module = None
+newsfeed_x = 0
 newsfeed_w = DISPLAY_WIDTH
 newsfeed_buffer = None
+newsfeed_pi = None
+
+# The scrolling position is driven by elapsed time, not by frames, so that the
+# speed stays steady even when the frame rate drops.  newsfeed_progress
+# accumulates the movement, in thousandths of a pixel, not yet shown.
+newsfeed_speed = 40  # pixels per second
+newsfeed_millis = 0
+newsfeed_progress = 0
 newsfeed_static = False
 
+# Headlines come pre-encoded as glyph indexes (see ccapi.make_item); the
+# scroller draws headline_glyphs up to headline_next_glyph, then a U+00B7 dot
+# as a separator, then moves on to the next headline.
 headline_index = 0
-headline_text = ''
-headline_next_char = 0
+headline_glyphs = None
+headline_next_glyph = 0
+separator_glyphs = None
 
 
 def reset_newsfeed():
@@ -136,71 +431,113 @@ def reset_newsfeed():
     last_newsfeed_module = None
 
 
-def format_item(item):
-    headline = item.headline.strip()
-    return f'{headline} ({item.source.strip()})' if item.source else headline
+def draw_wrapped_glyph(font, i, buffer, x):
+    # Draws glyph i into a ring buffer at column x, wrapping around the end,
+    # and returns its advance width.
+    w = font.cws[i]
+    buffer.fill(0, x, 0, x + w, font.h)
+    font.draw_glyph(i, buffer, x)
+    if x + w > buffer.width:
+        buffer.fill(0, 0, 0, x + w - buffer.width, font.h)
+        font.draw_glyph(i, buffer, x - buffer.width)
+    return w
 
 
 def render_newsfeed_module(bitmap, y, module, pi):
+    global newsfeed_x
     global newsfeed_w
     global newsfeed_buffer
+    global newsfeed_pi
+    global newsfeed_speed
+    global newsfeed_millis
+    global newsfeed_progress
     global newsfeed_static
     global headline_index
-    global headline_text
-    global headline_next_char
+    global headline_glyphs
+    global headline_next_glyph
+    global separator_glyphs
     global last_newsfeed_module
 
     if not module.items:
         print('Newsfeed contains no items.')
+        begin_band(bitmap, y, ())
         return
 
     if not newsfeed_buffer:
         newsfeed_buffer = Bitmap(DISPLAY_WIDTH + 20, large.h, 2)
+        separator_glyphs = large.encode(' \xb7 ')
 
     if module != last_newsfeed_module:
         last_newsfeed_module = module
+        newsfeed_x = 0
         newsfeed_w = DISPLAY_WIDTH
         newsfeed_buffer.fill(0)
         newsfeed_static = False
+        newsfeed_speed = prefs.get_int('newsfeed_speed', 40)
+        newsfeed_millis = cctime.monotonic_millis()
+        newsfeed_progress = 0
+        invalidate(y)
         # Don't reset headline_index, so that we keep making progress to the
         # next headline when flipping between the newsfeed and a custom message.
-        headline_text = ''
-        headline_next_char = 0
+        headline_glyphs = None
+        headline_next_glyph = 0
 
     n = len(module.items)
     item = module.items[headline_index % n]
 
-    if n == 1 and not headline_text:
-        headline_text = format_item(item)
-        newsfeed_w = large.measure(headline_text)
-        if newsfeed_w <= DISPLAY_WIDTH:
+    if n == 1 and headline_glyphs is None:
+        if item.width <= DISPLAY_WIDTH:
             # There is only one headline and it fits entirely; do not scroll.
-            large.draw(headline_text, newsfeed_buffer)
+            headline_glyphs = item.glyphs
+            newsfeed_w = item.width
+            large.draw_glyphs(item.glyphs, newsfeed_buffer)
             newsfeed_static = True
-        else:
-            newsfeed_w = DISPLAY_WIDTH
-            headline_text = ''
 
     if newsfeed_static:
+        if not begin_band(bitmap, y, (item.glyphs, pi)):
+            return
         x = (DISPLAY_WIDTH - newsfeed_w) // 2
         bitmap.freeblit(x, y, newsfeed_buffer, dest_value=pi)
         return
 
-    # The headline isn't static, so render it with a U+00B7 dot as a separator.
-    if not headline_text:
-        headline_text = format_item(item) + ' \xb7 '
-
-    # Move the headline over, then draw any more characters needed at the end.
-    newsfeed_buffer.freeblit(0, 0, newsfeed_buffer, 2, 0)
-    newsfeed_w -= 2
+    if headline_glyphs is None:
+        headline_glyphs = item.glyphs
+
+    # Move the headline over by as many pixels as the elapsed time calls for;
+    # if frames are late, this skips ahead.  Then draw any more characters
+    # needed at the end.
+    now = cctime.monotonic_millis()
+    newsfeed_progress += (now - newsfeed_millis) * newsfeed_speed
+    newsfeed_millis = now
+    dx = min(newsfeed_progress // 1000, DISPLAY_WIDTH)
+    newsfeed_progress = min(newsfeed_progress - dx * 1000, 1000)
+    if dx <= 0 and band_keys.get(y) is newsfeed_buffer and pi == newsfeed_pi:
+        return
+    bw = newsfeed_buffer.width
+    newsfeed_x = (newsfeed_x + dx) % bw
+    newsfeed_w -= dx
     while newsfeed_w < DISPLAY_WIDTH:
-        if headline_next_char >= len(headline_text):
-            headline_index += 1
-            item = module.items[headline_index % n]
-            headline_text = format_item(item) + ' \xb7 '
-            headline_next_char = 0
-        ch = headline_text[headline_next_char]
-        headline_next_char += 1
-        newsfeed_w = large.draw(ch, newsfeed_buffer, newsfeed_w, 0)
-
-    bitmap.freeblit(0, y, newsfeed_buffer, dest_value=pi)
+        if headline_next_glyph >= len(headline_glyphs):
+            if headline_glyphs is separator_glyphs:
+                headline_index += 1
+                headline_glyphs = module.items[headline_index % n].glyphs
+            else:
+                headline_glyphs = separator_glyphs
+            headline_next_glyph = 0
+            continue
+        i = headline_glyphs[headline_next_glyph]
+        headline_next_glyph += 1
+        newsfeed_w += draw_wrapped_glyph(
+            large, i, newsfeed_buffer, (newsfeed_x + newsfeed_w) % bw)
+
+    # Copy the visible part of the ring buffer, in at most two pieces.  These
+    # cover the whole band, so there's no need to clear it first.
+    w = min(DISPLAY_WIDTH, bw - newsfeed_x)
+    bitmap.freeblit(0, y, newsfeed_buffer, newsfeed_x, 0, w, large.h,
+        dest_value=pi)
+    if w < DISPLAY_WIDTH:
+        bitmap.freeblit(w, y, newsfeed_buffer, 0, 0, DISPLAY_WIDTH - w, large.h,
+            dest_value=pi)
+    band_keys[y] = newsfeed_buffer
+    newsfeed_pi = pi
+    display.damage(0, y, DISPLAY_WIDTH, y + large.h)
@@ -2,6 +2,7 @@ import ccapi
 from ccinput import ButtonReader, DialReader, Press
 import cctime
 import ccui
+import defn_cache
 import display
 import fs
 from microfont import small
@@ -21,8 +22,17 @@ class ClockMode:
         self.custom_message = ccapi.Newsfeed(
             'custom_message', 'newsfeed', 'lifeline', [], [], [])
 
+        # Prefs that are needed on every frame are kept up to date here.
+        self.dual_mode = False
+        self.auto_cycling = 0
+        prefs.subscribe('display_mode', self.set_display_mode)
+        prefs.subscribe('auto_cycling', self.set_auto_cycling)
+
         self.langs = {}
+        self.loader = None
         self.load_definition()
+        while self.loader:
+            self.load_step()
         self.updater = SoftwareUpdater(app, net, self)
         utils.log('Created SoftwareUpdater')
 
@@ -43,38 +53,85 @@ class ClockMode:
         })
         self.dial_reader = DialReader('SELECTOR', dial_map['SELECTOR'], 1)
         self.low_battery_cv = display.get_pi(0xff, 0, 0)
+        self.battery_cv = 0
+        self.lock_text_shown = False
 
-    def load_definition(self):
+    # Starts loading the definition file for the current language.  The file
+    # is parsed a piece at a time by load_step(), so that the clock keeps
+    # running, and the new definition replaces the old one only once it has
+    # been completely and successfully loaded.  A definition that has
+    # already been loaded can also be given directly.
+    def load_definition(self, defn=None):
+        if self.loader:
+            self.loader.close()
+            self.loader = None
         lang = prefs.get('lang', 'en')
-        if self.load_path(f'data/clock.{lang}.json'):
-            return
-        if self.load_path(f'clock.{lang}.json'):
-            return
-        if self.load_path('data/clock.json'):
-            return
-        if self.load_path('clock.json'):
+        self.cache_source = f'data/clock.{lang}.json'
+        self.cache_etag = prefs.get(f'api_etag_{lang}')
+        if not defn:
+            try:
+                defn = defn_cache.load(self.cache_source, self.cache_etag)
+            except Exception as e:
+                utils.report_error(e, 'Could not load definition cache')
+        if defn:
+            self.set_definition(defn)
             return
+        self.load_paths = [
+            f'data/clock.{lang}.json',
+            f'clock.{lang}.json',
+            'data/clock.json',
+            'clock.json'
+        ]
+        self.load_next_path()
+
+    def load_next_path(self):
+        self.loader = None
+        while self.load_paths:
+            self.loading_path = self.load_paths.pop(0)
+            if fs.isfile(self.loading_path):
+                # Items from the fetched API file are kept on flash, where
+                # the definition cache can refer to them.
+                items_path = temp_path = None
+                if self.loading_path == self.cache_source:
+                    items_path = ccapi.get_items_path(self.cache_source)
+                    temp_path = items_path + '.load'
+                self.loader = ccapi.Loader(
+                    fs.open(self.loading_path), items_path, temp_path)
+                return
 
-    def load_path(self, path):
+    def load_step(self):
         try:
-            with fs.open(path) as api_file:
-                defn = ccapi.load(api_file)
-            disp = defn.config.display
-            self.deadline_pi = display.get_pi(*disp.deadline.primary)
-            self.lifeline_pi = display.get_pi(*disp.lifeline.primary)
-            self.langs = defn.config.langs
-
-            for m in defn.modules:
-                if m.flavor == 'deadline':
-                    self.deadline = m
-
-            self.modules = utils.Cycle(defn.modules + [self.custom_message])
-            module_id = self.module and self.module.id or prefs.get('module_id')
-            self.advance_module(id=module_id)
-            utils.log(f'Loaded {path}')
-            return True
+            defn = self.loader.step()
         except Exception as e:
             print(e)
+            self.loader.close()
+            self.load_next_path()
+            return
+        if defn:
+            self.loader.close()
+            self.loader = None
+            self.set_definition(defn)
+            utils.log(f'Loaded {self.loading_path}')
+            if self.loading_path == self.cache_source and self.cache_etag:
+                try:
+                    defn_cache.save(self.cache_source, self.cache_etag, defn)
+                except Exception as e:
+                    utils.report_error(e, 'Could not save definition cache')
+
+    def set_definition(self, defn):
+        ccui.reset_layouts()
+        disp = defn.config.display
+        self.colours = (disp.deadline.primary, disp.lifeline.primary)
+        self.get_colours()
+        self.langs = defn.config.langs
+
+        for m in defn.modules:
+            if m.flavor == 'deadline':
+                self.deadline = m
+
+        self.modules = utils.Cycle(defn.modules + [self.custom_message])
+        module_id = self.module and self.module.id or prefs.get('module_id')
+        self.advance_module(id=module_id)
 
     def advance_module(self, delta=0, id=None):
         if delta:
@@ -88,7 +145,7 @@ class ClockMode:
         original_id = self.modules.advance(0).id
         m = self.modules.advance(delta)
         while (
-            m == self.deadline and prefs.get('display_mode') == 'DUAL' or
+            m == self.deadline and self.dual_mode or
             m == self.custom_message and not prefs.get('custom_message') or
             id and m.id != id
         ):
@@ -99,43 +156,63 @@ class ClockMode:
 
         # Render static parts of the display
         self.app.bitmap.fill(0)
-        if prefs.get('display_mode') != 'DUAL':
+        ccui.invalidate()
+        if not self.dual_mode:
             ccui.render_label(
                 self.app.bitmap, 16,
                 self.module.full_width_labels or self.module.labels,
                 self.deadline_pi if m == self.deadline else self.lifeline_pi
             )
 
+    def set_display_mode(self, display_mode):
+        self.dual_mode = display_mode == 'DUAL'
+
+    def set_auto_cycling(self, auto_cycling):
+        self.auto_cycling = max(0, prefs.to_int(auto_cycling, 0))
+
+    def get_colours(self):
+        display.release(self)
+        deadline_rgb, lifeline_rgb = self.colours
+        self.deadline_pi = display.get_pi(*deadline_rgb, owner=self)
+        self.lifeline_pi = display.get_pi(*lifeline_rgb, owner=self)
+
     def start(self):
+        self.get_colours()
         self.reader.reset()
         self.dial_reader.reset()
         self.app.bitmap.fill(0)
+        ccui.invalidate()
 
         self.next_advance = None
-        auto_cycling = prefs.get('auto_cycling')
-        if auto_cycling:
-            self.next_advance = cctime.monotonic_millis() + auto_cycling
+        if self.auto_cycling:
+            self.next_advance = cctime.monotonic_millis() + self.auto_cycling
 
         self.updates_paused_until_millis = cctime.try_isoformat_to_millis(
             prefs, 'updates_paused_until')
 
         ccui.reset_newsfeed()
         self.custom_message.items[:] = [
-            ccapi.Item(0, prefs.get('custom_message'), '')
+            ccapi.make_item(0, prefs.get('custom_message') or '', '')
         ]
         self.advance_module(0)
 
     def step(self):
+        if self.loader:
+            self.load_step()
+
         if self.next_advance and cctime.monotonic_millis() > self.next_advance:
-            auto_cycling = prefs.get('auto_cycling')
-            if auto_cycling and not self.app.locked:
-                self.next_advance += auto_cycling
+            if self.auto_cycling and not self.app.locked:
+                self.next_advance += self.auto_cycling
                 self.advance_module(1)
             else:
                 self.next_advance = None
 
         bitmap = self.app.bitmap
-        dual_mode = prefs.get('display_mode') == 'DUAL'
+        dual_mode = self.dual_mode
+        if self.lock_text_shown and self.app.lock_tick <= 0:
+            # Redraw the band that was underneath the locking message.
+            ccui.invalidate(0)
+            self.lock_text_shown = False
 
         if self.module == self.deadline or dual_mode:
             ccui.render_module(bitmap, 0, self.deadline, self.deadline_pi)
@@ -153,15 +230,22 @@ class ClockMode:
             else:
                 text = 'Display is '
                 text += 'locked.' if self.app.locked else 'unlocked.'
-            bitmap.fill(0, 0, 0, small.measure(text) + 1, small.h + 1)
+            w = small.measure(text) + 1
+            bitmap.fill(0, 0, 0, w, small.h + 1)
             small.draw(text, bitmap, 1, 0)
+            display.damage(0, 0, w, small.h + 1)
+            self.lock_text_shown = True
 
         level = self.app.battery_sensor.level
         if level is not None and level < 10:
             blink = cctime.monotonic_millis() % 1500
-            bitmap.fill(self.low_battery_cv * (blink < 1000), 190, 30, 192, 32)
+            cv = self.low_battery_cv * (blink < 1000)
+            bitmap.fill(cv, 190, 30, 192, 32)
+            if cv != self.battery_cv:
+                self.battery_cv = cv
+                display.damage(190, 30, 192, 32)
 
-        display.send()
+        display.send_damage()
         if cctime.get_millis() > (self.updates_paused_until_millis or 0):
             if not self.app.locked:
                 self.updater.step()
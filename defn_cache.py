@@ -0,0 +1,217 @@
+"""Binary cache of compiled clock definitions.
+
+Parsing the API file's JSON is slow, so after a definition has been loaded,
+the records that ccapi built from it are saved in a compact binary file next
+to the JSON file.  The cache is tagged with the ETag of the API response it
+was built from, and is only used while that ETag is still current.
+
+Each distinct string is stored once in a table at the start of the file, so
+the labels shared by many modules are also shared in memory once loaded.
+"""
+
+from array import array
+import ccapi
+import fs
+import os
+import struct
+
+MAGIC = b'cc\x01'
+
+# Type codes for the values in a cache file.
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT = 3  # signed 32-bit integer
+BIGINT = 4  # integer stored as a decimal string
+FLOAT = 5  # float stored as a decimal string
+STR = 6
+LIST = 7
+TUPLE = 8
+DICT = 9
+GLYPHS = 10  # array of unsigned 16-bit glyph indexes
+RECORD = 11  # one of the RECORD_TYPES, with its number of fields
+STORE = 12  # an ItemStore's file path and its unsigned 32-bit item offsets
+
+RECORD_TYPES = [
+    ccapi.Config, ccapi.Display, ccapi.Palette, ccapi.Item,
+    ccapi.Timer, ccapi.Newsfeed, ccapi.Value
+]
+
+
+def get_path(path):
+    return path + '.cache'
+
+
+def save(path, etag, defn):
+    """Saves a cache of defn, loaded from the API file at path."""
+    strings = {}
+    body = bytearray()
+    encode(body, strings, (defn.config, list(defn.module_dict.values())))
+    with fs.write_indicator:
+        with fs.open(get_path(path) + '.new', 'wb') as file:
+            file.write(MAGIC)
+            write_str(file, etag)
+            table = [None]*len(strings)
+            for string, index in strings.items():
+                table[index] = string
+            file.write(struct.pack('<H', len(table)))
+            for string in table:
+                write_str(file, string)
+            file.write(body)
+        fs.move(get_path(path) + '.new', get_path(path))
+
+
+def load(path, etag):
+    """Loads the cached definition for the API file at path, or returns None
+    if there is no cache for the given ETag."""
+    if not etag or not fs.isfile(get_path(path)):
+        return None
+    data = bytearray(os.stat(get_path(path))[6])
+    with fs.open(get_path(path)) as file:
+        file.readinto(data)
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    reader = Reader(data)
+    reader.pos = len(MAGIC)
+    if reader.read_str() != etag:
+        return None
+    reader.strings = [reader.read_str() for i in range(reader.read_u16())]
+    config, modules = reader.read()
+    module_dict = {module.id: module for module in modules}
+    return ccapi.Defn(
+        config,
+        module_dict,
+        [module_dict[module_id] for module_id in config.module_ids
+         if module_id in module_dict]
+    )
+
+
+def write_str(file, string):
+    data = string.encode()
+    file.write(struct.pack('<H', len(data)))
+    file.write(data)
+
+
+def encode(out, strings, value):
+    if value is None:
+        out.append(NONE)
+    elif value is False:
+        out.append(FALSE)
+    elif value is True:
+        out.append(TRUE)
+    elif isinstance(value, int):
+        if -0x80000000 <= value < 0x80000000:
+            out.append(INT)
+            out.extend(struct.pack('<i', value))
+        else:
+            out.append(BIGINT)
+            encode_index(out, strings, str(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        encode_index(out, strings, repr(value))
+    elif isinstance(value, str):
+        out.append(STR)
+        encode_index(out, strings, value)
+    elif isinstance(value, ccapi.ItemStore):
+        out.append(STORE)
+        encode_index(out, strings, value.path)
+        out.extend(struct.pack('<H', len(value.offsets)))
+        for offset in value.offsets:
+            out.extend(struct.pack('<L', offset))
+    elif isinstance(value, array):
+        out.append(GLYPHS)
+        out.extend(struct.pack('<H', len(value)))
+        for glyph in value:
+            out.extend(struct.pack('<H', glyph))
+    elif type(value) in RECORD_TYPES:
+        out.append(RECORD)
+        out.append(RECORD_TYPES.index(type(value)))
+        out.append(len(value))
+        for item in value:
+            encode(out, strings, item)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST if isinstance(value, list) else TUPLE)
+        out.extend(struct.pack('<H', len(value)))
+        for item in value:
+            encode(out, strings, item)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        out.extend(struct.pack('<H', len(value)))
+        for key, item in value.items():
+            encode(out, strings, key)
+            encode(out, strings, item)
+    else:
+        raise TypeError(f'Cannot cache {type(value)}')
+
+
+def encode_index(out, strings, string):
+    if string not in strings:
+        strings[string] = len(strings)
+    out.extend(struct.pack('<H', strings[string]))
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.strings = []
+
+    def read_u16(self):
+        self.pos += 2
+        return self.data[self.pos - 2] | (self.data[self.pos - 1] << 8)
+
+    def read_str(self):
+        length = self.read_u16()
+        self.pos += length
+        return str(self.data[self.pos - length:self.pos], 'utf-8')
+
+    def read(self):
+        code = self.data[self.pos]
+        self.pos += 1
+        if code == NONE:
+            return None
+        if code == FALSE:
+            return False
+        if code == TRUE:
+            return True
+        if code == INT:
+            self.pos += 4
+            return struct.unpack_from('<i', self.data, self.pos - 4)[0]
+        if code == BIGINT:
+            return int(self.strings[self.read_u16()])
+        if code == FLOAT:
+            return float(self.strings[self.read_u16()])
+        if code == STR:
+            return self.strings[self.read_u16()]
+        if code == LIST or code == TUPLE:
+            items = [self.read() for i in range(self.read_u16())]
+            return items if code == LIST else tuple(items)
+        if code == DICT:
+            result = {}
+            for i in range(self.read_u16()):
+                key = self.read()
+                result[key] = self.read()
+            return result
+        if code == GLYPHS:
+            length = self.read_u16()
+            glyphs = array('H', bytes(length*2))
+            for i in range(length):
+                glyphs[i] = self.read_u16()
+            return glyphs
+        if code == RECORD:
+            record_type = RECORD_TYPES[self.data[self.pos]]
+            length = self.data[self.pos + 1]
+            self.pos += 2
+            return record_type(*[self.read() for i in range(length)])
+        if code == STORE:
+            path = self.strings[self.read_u16()]
+            if not fs.isfile(path):
+                raise ValueError(f'Missing newsfeed item file {path}')
+            length = self.read_u16()
+            offsets = array('L')
+            for i in range(length):
+                self.pos += 4
+                offsets.append(
+                    struct.unpack_from('<L', self.data, self.pos - 4)[0])
+            return ccapi.ItemStore(path, offsets)
+        raise ValueError(f'Bad type code {code} in definition cache')
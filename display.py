@@ -1,8 +1,13 @@
+from array import array
 import board
 import displayio
 import framebufferio
 import prefs
 import rgbmatrix
+try:
+    import bitmaptools
+except ImportError:
+    bitmaptools = None
 
 # NOTE: Setting BIT_DEPTH to 5 gives the best colour rendering and brightness
 # control (higher than 5 doesn't help because the hardware colour depth appears
@@ -11,16 +16,33 @@ import rgbmatrix
 BIT_DEPTH = 5
 
 brightness = 1.0
-colours = [(0, 0, 0)]
 shader = [0]
 fb_display = None
+bitmap = None
+
+# The palette is managed with reference counts: each palette index is held by
+# the owners that asked for it with get_pi().  An owner of None holds its
+# colours forever; other owners let go of all theirs with release().  A
+# palette index that nobody holds keeps its colour (so asking for the same
+# colour again costs nothing) until its slot is needed for another colour.
+colours = [(0, 0, 0)]  # RGB colour of each palette index
+colour_pis = {(0, 0, 0): 0}  # palette index of each RGB colour
+refs = [1]  # number of owners holding each palette index
+owned_pis = {None: {0}}  # set of palette indexes held by each owner
+unerased_pis = set()  # released indexes that may still be drawn in the bitmap
+
+# The bounding box [x1, y1, x2, y2] of the parts of the bitmap that have
+# changed since the display was last updated, or None if nothing has changed.
+damaged = None
 
 
 # Sets up the matrix display to show the contents of a given bitmap.
-def init(bitmap):
+def init(new_bitmap):
+    global bitmap
     global shader
     global fb_display
 
+    bitmap = new_bitmap
     prefs.init()
     rgb_pin_names = prefs.get('rgb_pins').split()
     addr_pin_names = prefs.get('addr_pins').split()
@@ -50,30 +72,89 @@ def send():
     fb_display.auto_refresh = False
 
 
+# Records that a rectangle of the bitmap has changed (by default, all of it).
+def damage(x1=0, y1=0, x2=0xffff, y2=0xffff):
+    global damaged
+    if damaged:
+        damaged[0] = min(damaged[0], x1)
+        damaged[1] = min(damaged[1], y1)
+        damaged[2] = max(damaged[2], x2)
+        damaged[3] = max(damaged[3], y2)
+    else:
+        damaged = [x1, y1, x2, y2]
+
+
+# Updates the display only if some part of the bitmap has been damaged.
+def send_damage():
+    global damaged
+    if damaged:
+        damaged = None
+        send()
+    else:
+        idle()
+
+
+# Called instead of send() on frames where there is nothing new to show.
+def idle():
+    pass
+
+
 def srgb_to_linear(v):
     if v <= 0.04045:
         return v / 12.92
     return ((v + 0.055) / 1.055)**2.4
 
 
-def get_shader_rgb(r, g, b, brightness):
+# Linear intensities, from 0 to LINEAR_MAX, of each 8-bit colour component
+# value in the current colorspace.  Built once per colorspace so that changing
+# the brightness needs only integer arithmetic.
+LINEAR_MAX = 0x1000
+linear_table = None
+linear_colorspace = None
+
+
+def get_linear_table():
+    global linear_table
+    if linear_table is None:
+        linear_table = array('H', bytes(0x200))
+        for v in range(0x100):
+            value = v / 255.0
+            if linear_colorspace == 'SRGB':
+                value = srgb_to_linear(value)
+            linear_table[v] = int(value * LINEAR_MAX + 0.5)
+    return linear_table
+
+
+def set_colorspace(colorspace):
+    global linear_table
+    global linear_colorspace
+    if colorspace != linear_colorspace:
+        linear_table = None
+        linear_colorspace = colorspace
+
+
+prefs.subscribe('colorspace', set_colorspace)
+
+
+# Converts a brightness level from 0.0 to 1.0 to an integer scale factor
+# for get_shader_rgb.
+def get_scale(brightness):
+    return int(brightness * 255.99 * 0x100)
+
+
+def get_shader_rgb(r, g, b, scale, table):
     min_value = 0x100 >> BIT_DEPTH
-    mid = (r + g + b)/3
+    total = r + g + b
     # When scaling down, don't scale down any nonzero values to zero,
     # and avoid scaling down saturated colours to pure grey.
-    min_r = 2*min_value if r > mid else min_value if r else 0
-    min_g = 2*min_value if g > mid else min_value if g else 0
-    min_b = 2*min_value if b > mid else min_value if b else 0
-    r, g, b = r / 255.0, g / 255.0, b / 255.0
-    if prefs.get('colorspace') == 'SRGB':
-        r = srgb_to_linear(r)
-        g = srgb_to_linear(g)
-        b = srgb_to_linear(b)
-    factor = brightness * 255.99
+    min_r = 2*min_value if 3*r > total else min_value if r else 0
+    min_g = 2*min_value if 3*g > total else min_value if g else 0
+    min_b = 2*min_value if 3*b > total else min_value if b else 0
+    # LINEAR_MAX * scale stays below 2**28, so this never leaves small ints.
     return (
-        max(min_r, int(factor * r)),
-        max(min_g, int(factor * g)),
-        max(min_b, int(factor * b))
+        max(min_r, (table[r] * scale) >> 20),
+        max(min_g, (table[g] * scale) >> 20),
+        max(min_b, (table[b] * scale) >> 20)
     )
 
 
@@ -88,24 +169,93 @@ def blank():
 def set_brightness(new_brightness):
     global brightness
     brightness = new_brightness
+    scale = get_scale(brightness)
+    table = get_linear_table()
     for pi in range(len(colours)):
         r, g, b = colours[pi]
-        sr, sg, sb = get_shader_rgb(r, g, b, brightness)
+        sr, sg, sb = get_shader_rgb(r, g, b, scale, table)
         shader[pi] = ((sr << 16) | (sg << 8) | sb)
 
 
-# Allocates or retrieves the palette index for the given RGB colour.
-def get_pi(r, g, b):
-    for pi, rgb in enumerate(colours):
-        if rgb == (r, g, b):
-            return pi
+# Allocates or retrieves the palette index for the given RGB colour, and
+# records that owner holds it.
+def get_pi(r, g, b, owner=None):
+    rgb = (r, g, b)
+    pi = colour_pis.get(rgb)
+    if pi is None:
+        pi = allocate_pi(rgb)
+    held = owned_pis.get(owner)
+    if held is None:
+        held = owned_pis[owner] = set()
+    if pi not in held:
+        held.add(pi)
+        refs[pi] += 1
+    return pi
+
+
+# Lets go of all the palette indexes held by owner.  Pass erased=True if the
+# whole bitmap has just been cleared, so nothing released is left on screen.
+def release(owner, erased=False):
+    if erased:
+        unerased_pis.clear()
+    if owner is not None:
+        for pi in owned_pis.pop(owner, ()):
+            refs[pi] -= 1
+            if not erased:
+                unerased_pis.add(pi)
+
+
+def allocate_pi(rgb):
     if len(colours) < len(shader):
         pi = len(colours)
-        colours.append((r, g, b))
-        sr, sg, sb = get_shader_rgb(r, g, b, brightness)
-        shader[pi] = ((sr << 16) | (sg << 8) | sb)
-        return pi
-    return 1  # no more palette slots available; just return 1
+        colours.append(rgb)
+        refs.append(0)
+    else:
+        pi = reclaim_pi()
+        if pi is None:
+            print(f'No palette slots left for {rgb}; using nearest colour')
+            return get_nearest_pi(rgb)
+        del colour_pis[colours[pi]]
+        colours[pi] = rgb
+    colour_pis[rgb] = pi
+    r, g, b = rgb
+    sr, sg, sb = get_shader_rgb(
+        r, g, b, get_scale(brightness), get_linear_table())
+    shader[pi] = ((sr << 16) | (sg << 8) | sb)
+    return pi
+
+
+# Finds a palette index that nobody holds, and blanks any pixels of the live
+# bitmap still drawn with it, so that they don't reappear in the new colour.
+def reclaim_pi():
+    for pi in range(1, len(refs)):
+        if refs[pi] == 0:
+            if pi in unerased_pis:
+                unerased_pis.discard(pi)
+                if bitmap is not None:
+                    replace_pi(bitmap, pi, 0)
+                    damage()
+            return pi
+
+
+def replace_pi(bitmap, old_pi, new_pi):
+    if hasattr(bitmaptools, 'replace_color'):  # CircuitPython 9 and later
+        bitmaptools.replace_color(bitmap, old_pi, new_pi)
+    else:  # a Python loop over every pixel; tens of ms for 192 x 32
+        for i in range(bitmap.width * bitmap.height):
+            if bitmap[i] == old_pi:
+                bitmap[i] = new_pi
+
+
+def get_nearest_pi(rgb):
+    r, g, b = rgb
+    best_pi, best_d = 1, None
+    for pi in range(1, len(colours)):
+        cr, cg, cb = colours[pi]
+        d = (cr - r)*(cr - r) + (cg - g)*(cg - g) + (cb - b)*(cb - b)
+        if best_d is None or d < best_d:
+            best_pi, best_d = pi, d
+    return best_pi
 
 
 # Gets the RGB values for the given palette index.
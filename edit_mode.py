@@ -37,8 +37,6 @@ DISPLAY_TEXT_MENU = [
 class EditMode:
     def __init__(self, app, button_map, dial_map):
         self.app = app
-        self.pi = display.get_pi(0x80, 0x80, 0x80)
-        self.cursor_pi = display.get_pi(0x00, 0xff, 0x00)
 
         self.reader = ButtonReader(button_map, {
             'UP': {
@@ -73,6 +71,8 @@ class EditMode:
             self.menu = ASCII_TEXT_MENU
 
     def start(self):
+        self.pi = display.get_pi(0x80, 0x80, 0x80, self)
+        self.cursor_pi = display.get_pi(0x00, 0xff, 0x00, self)
         self.reader.reset()
         self.dial_reader.reset()
         self.app.bitmap.fill(0)
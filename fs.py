@@ -5,6 +5,11 @@ import utils
 builtin_open = open
 write_indicator = utils.null_context
 
+# Directories that make_parent has found or created, so that it doesn't have
+# to stat them again.  Anything that removes or renames a directory must
+# remove it from this set (see forget()).
+known_dirs = set()
+
 
 def open(path, mode='rb'):
     make_parent(path)
@@ -14,6 +19,7 @@ def open(path, mode='rb'):
 def move(path, newpath):
     with write_indicator:
         destroy(newpath)
+        forget(path)
         os.rename(path, newpath)
 
 
@@ -24,6 +30,48 @@ def append(path, data):
                 file.write(data)
 
 
+# Appends to a file through a write-behind buffer, so that a download
+# received in small pieces is written in fewer, larger writes, through one
+# open handle, with one flash write indication per write.  Data is only
+# guaranteed to be on disk after flush() or close().
+class Appender:
+    def __init__(self, path, buffer_length=4096):
+        self.path = path
+        self.file = None
+        self.buffer = bytearray(buffer_length)
+        self.length = 0  # number of bytes waiting in the buffer
+
+    def write(self, data):
+        if self.length + len(data) > len(self.buffer):
+            self.flush()
+        if len(data) > len(self.buffer):
+            self.write_file(data)
+        elif data:
+            self.buffer[self.length:self.length + len(data)] = data
+            self.length += len(data)
+
+    def flush(self):
+        if self.length:
+            try:
+                self.write_file(memoryview(self.buffer)[:self.length])
+            finally:
+                self.length = 0  # a failed write is not attempted again
+
+    def write_file(self, data):
+        with write_indicator:
+            if not self.file:
+                self.file = open(self.path, 'ab')
+            self.file.write(data)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.file:
+                file, self.file = self.file, None
+                file.close()
+
+
 def write_json(path, obj):
     with write_indicator:
         with open(path + '.new', 'wt') as file:
@@ -33,14 +81,32 @@ def write_json(path, obj):
 
 def destroy(path):  # removes a file or directory and all descendants
     with write_indicator:
-        if isdir(path):
-            for file in os.listdir(path):
-                destroy(path + '/' + file)
-            os.rmdir(path)
-        if isfile(path):
+        mode = get_mode(path)
+        if mode & 0x4000:
+            forget(path)
+            destroy_dir(path)
+        elif mode & 0x8000:
             os.remove(path)
 
 
+def destroy_dir(path):  # stats each descendant only once
+    for name in os.listdir(path):
+        child = path + '/' + name
+        if get_mode(child) & 0x4000:
+            destroy_dir(child)
+        else:
+            os.remove(child)
+    os.rmdir(path)
+
+
+def forget(path):  # removes a directory and its descendants from known_dirs
+    path = path.strip('/')
+    prefix = path + '/'
+    for dir in [dir for dir in known_dirs if dir.startswith(prefix)]:
+        known_dirs.remove(dir)
+    known_dirs.discard(path)
+
+
 def free():
     _, frsize, _, _, bfree = os.statvfs('.')[:5]
     return frsize*bfree
@@ -69,10 +135,13 @@ def make_parent(path):
     parts = path.strip('/').split('/')
     path = parts[0]
     for part in parts[1:]:
-        if isfile(path):
-            with write_indicator:
-                os.remove(path)
-        if not isdir(path):
-            with write_indicator:
-                os.mkdir(path)
+        if path not in known_dirs:
+            mode = get_mode(path)
+            if mode & 0x8000:
+                with write_indicator:
+                    os.remove(path)
+            if not mode & 0x4000:
+                with write_indicator:
+                    os.mkdir(path)
+            known_dirs.add(path)
         path += '/' + part
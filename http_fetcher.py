@@ -1,7 +1,13 @@
 import cctime
+import memory
 import prefs
 import utils
 
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
 # If the remote server has stopped sending data for this many milliseconds,
 # assume the HTTP response is finished.
 SILENCE_TIMEOUT = 10000
@@ -9,26 +15,83 @@ SILENCE_TIMEOUT = 10000
 # To limit memory use, we read this many bytes from the network at a time.
 PACKET_LENGTH = 1500 - 20 - 20  # 1500 - IP header (20) - TCP header (20)
 
+# The receive buffer is allocated once; each status or header line has to fit
+# in it whole.
+BUFFER_LENGTH = PACKET_LENGTH * 2
+
+# Compressed bodies are only requested if zlib can decompress a stream
+# incrementally; each read() then yields at most PACKET_LENGTH bytes.
+STREAMING_ZLIB = hasattr(zlib, 'decompressobj')
+ZLIB_WBITS = {'deflate': 15, 'gzip': 16 + 15}
+
+# The server chooses the compression window, up to 32 kB, and the client
+# has no way to ask for a smaller one; the decompressor has to allocate a
+# window as large as the server used.  So compression is only requested
+# when there is room for the largest window with plenty to spare.
+ZLIB_MIN_FREE = 64*1024
+
 
 class HttpFetcher:
     def __init__(self, net):
         self.net = net
-        self.buffer = bytearray()
+        # Received bytes that haven't been consumed yet are buffer[head:tail].
+        # Consuming bytes just advances head, so nothing gets moved or copied
+        # except for the occasional partial line (see receive()).
+        self.buffer = bytearray(BUFFER_LENGTH)
+        self.view = memoryview(self.buffer)
+        self.packet_view = self.view[:PACKET_LENGTH]
+        self.head = self.tail = 0
+        # The connection is left open after a response that ended cleanly,
+        # so the next request to the same server can skip the handshake.
+        self.ssl = self.host = None
+        self.reusable = False
 
-    def go(self, url, req_etag=None):
-        self.ssl, self.host, self.path = utils.split_url(url)
+    # Fetches url, or the part of it from byte offset start to the end.  When
+    # start is nonzero, check self.status: if the server ignored the Range
+    # header, it is b'200' and the entire body will follow.
+    def go(self, url, req_etag=None, start=0):
+        ssl, host, self.path = utils.split_url(url)
         self.req_etag = req_etag
-        if not self.host:
+        self.range_start = start
+        if not host:
             raise ValueError(f'Invalid URL: {url}')
+        if self.net.state == 'CONNECTED' and not (
+            self.reusable and ssl == self.ssl and host == self.host):
+            self.net.close()
+        self.ssl, self.host = ssl, host
         self.start()
 
     def start(self):
-        self.buffer[:] = b''
+        self.head = self.tail = 0
         self.silence_started = None
+        self.chunked = False
+        self.resp_etag = None
+        self.reused = self.reusable and self.net.state == 'CONNECTED'
+        self.reusable = False
         # Calling read() returns anywhere from zero to PACKET_LENGTH bytes, or
-        # None; b'' or None does not indicate EOF.  StopIteration indicates EOF.
+        # None; an empty result or None does not indicate EOF.  StopIteration
+        # indicates EOF.  The bytes are returned as a memoryview into the
+        # receive buffer, which is only valid until the next call to read().
         self.read = self.connect_read
 
+    # Receives up to PACKET_LENGTH more bytes into the end of the buffer.
+    def receive(self):
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        elif self.tail + PACKET_LENGTH > BUFFER_LENGTH and self.head:
+            # Move the partial line at the end of the buffer to the start.
+            length = self.tail - self.head
+            self.buffer[:length] = self.buffer[self.head:self.tail]
+            self.head, self.tail = 0, length
+        count = min(PACKET_LENGTH, BUFFER_LENGTH - self.tail)
+        if not count:
+            raise ValueError(f'HTTP line longer than {BUFFER_LENGTH} bytes')
+        view = self.view[self.tail:self.tail + count]
+        self.tail += self.net.receive_into(view)
+
+    def find_crlf(self):
+        return self.buffer.find(b'\r\n', self.head, self.tail)
+
     def check_silence_timeout(self, is_silent):
         now = cctime.monotonic_millis()
         if is_silent:
@@ -37,6 +100,8 @@ class HttpFetcher:
                 if silence > SILENCE_TIMEOUT:
                     utils.log(f'Closing socket after {silence} s of silence.')
                     self.net.close()
+                    if self.chunked:  # a chunked body must end with a 0 chunk
+                        raise ValueError('Chunked response was cut off')
                     raise StopIteration(self.resp_etag)
             else:
                 self.silence_started = now
@@ -52,77 +117,202 @@ class HttpFetcher:
             self.net.connect(self.host, ssl=self.ssl)
         elif self.net.state == 'CONNECTED':
             etag = utils.to_bytes(self.req_etag or b'')
-            utils.log(f'Fetching {self.path} from {self.host} (ETag {etag}).')
+            start = self.range_start
+            utils.log(f'Fetching {self.path} from {self.host} ' +
+                f'(ETag {etag}, from byte {start}).')
             self.net.send(
                 b'GET ' + utils.to_bytes(self.path) + b' HTTP/1.1\r\n' +
                 b'Host: ' + utils.to_bytes(self.host) + b'\r\n' +
-                b'Connection: Close\r\n' +
-                (b'If-None-Match: "' + etag + b'"\r\n' if etag else b'') +
+                # The unpacker counts offsets in the uncompressed body, so a
+                # resumed download must not be compressed.
+                (b'Accept-Encoding: gzip, deflate\r\n'
+                    if self.can_decompress() and not start else b'') +
+                (b'Range: bytes=' + utils.to_bytes(start) + b'-\r\n'
+                    if start else b'') +
+                (b'If-None-Match: ' + etag + b'\r\n' if etag else b'') +
                 b'\r\n'
             )
             self.read = self.http_status_read
 
+    def can_decompress(self):
+        if not STREAMING_ZLIB:
+            return False
+        return not memory.measurable or memory.get_free() >= ZLIB_MIN_FREE
+
     def http_status_read(self):
         self.net.step()
-        data = self.net.receive(PACKET_LENGTH)
-        self.buffer.extend(data)
-        crlf = self.buffer.find(b'\r\n')
+        self.receive()
+        crlf = self.find_crlf()
+        if crlf < 0 and self.reused and self.net.state != 'CONNECTED':
+            # The server closed the kept-alive connection before answering.
+            utils.log('Server closed idle connection; reconnecting.')
+            self.start()
+            return
         self.check_silence_timeout(crlf < 0)
-        if crlf > 0:
-            status = bytes(self.buffer[:crlf]).split(b' ')[1]
-            self.buffer[:crlf + 2] = b''
+        if crlf > self.head:
+            version, status = bytes(self.view[self.head:crlf]).split(b' ')[:2]
+            self.head = crlf + 2
             utils.log(f'HTTP status: {status}')
-            if status == b'304':
-                raise StopIteration(304)
-            if status != b'200' and status != b'301' and status != b'302':
+            if status not in [b'200', b'206', b'301', b'302', b'304']:
                 raise ValueError(f'HTTP status {status}')
+            self.status = status
+            self.keep_alive = version != b'HTTP/1.0'
             self.content_length = -1
-            self.resp_etag = None
+            self.chunked = False
+            self.decompressor = None
             self.read = self.http_headers_read
 
     def http_headers_read(self):
         self.net.step()
-        crlf = self.buffer.find(b'\r\n')
+        crlf = self.find_crlf()
         self.check_silence_timeout(crlf < 0)
-        if crlf > 0:
-            colon = self.buffer.find(b':')
-            if 0 < colon < crlf:
-                key = bytes(self.buffer[:colon]).lower()
-                value = utils.to_str(bytes(self.buffer[colon + 1:crlf])).strip()
+        if crlf > self.head:
+            colon = self.buffer.find(b':', self.head, crlf)
+            if colon > self.head:
+                key = bytes(self.view[self.head:colon]).lower()
+                value = utils.to_str(bytes(self.view[colon + 1:crlf])).strip()
                 if key == b'content-length':
                     self.content_length = int(value)
+                if key == b'connection' and value.lower() == 'close':
+                    self.keep_alive = False
+                if key == b'transfer-encoding':
+                    self.chunked = value.lower().endswith('chunked')
+                if key == b'content-encoding':
+                    wbits = ZLIB_WBITS.get(value.lower())
+                    if wbits:
+                        self.decompressor = zlib.decompressobj(wbits)
+                        self.unconsumed = b''
                 if key == b'etag':
-                    self.resp_etag = value.strip('"')
+                    # Kept exactly as sent (quotes and any W/ prefix included)
+                    # so that it can be sent back verbatim in If-None-Match.
+                    self.resp_etag = value
                 if key == b'location':
                     self.net.close()
                     utils.log(f'Redirection: {value}')
                     if value.startswith('http:') or value.startswith('https:'):
-                        self.go(value)
+                        self.go(value, start=self.range_start)
                     elif value.startswith('/'):
                         self.path = value
                         self.start()
                     else:
                         self.path = self.path.rsplit('/', 1)[0] + '/' + value
                         self.start()
-            self.buffer[:crlf + 2] = b''
-        elif crlf == 0:
-            self.buffer[:2] = b''
+                    return
+            self.head = crlf + 2
+        elif crlf == self.head:
+            self.head = crlf + 2
+            if self.status == b'304':  # 304 means Not Modified
+                self.finish(304)
             self.received_length = 0
-            self.read = self.content_read
+            if self.chunked:
+                self.read_body = self.chunk_size_read
+            else:
+                self.read_body = self.content_read
+            if self.decompressor:
+                self.read = self.decompress_read
+            else:
+                self.read = self.body_read
         else:
-            self.buffer.extend(self.net.receive(PACKET_LENGTH))
+            self.receive()
+
+    # Ends the response, closing the connection unless it can be reused.
+    def finish(self, result):
+        self.reusable = self.keep_alive and self.net.state == 'CONNECTED'
+        if not self.reusable:
+            self.net.close()
+        raise StopIteration(result)
+
+    # The body is read by a series of states in self.read_body, the same way
+    # that self.read steps through the states before the body.
+    def body_read(self):
+        return self.read_body()
+
+    def decompress_read(self):
+        data = self.unconsumed
+        if not data:
+            try:
+                data = self.read_body()
+            except StopIteration:
+                if not self.decompressor.eof:
+                    raise ValueError('Compressed response was cut off')
+                raise
+            if not data:
+                return data
+        chunk = self.decompressor.decompress(data, PACKET_LENGTH)
+        self.unconsumed = self.decompressor.unconsumed_tail
+        return chunk
 
     def content_read(self):
         self.net.step()
-        if (self.received_length >= self.content_length > 0 or  # file completed
-            self.net.state != 'CONNECTED'):  # server closed the connection
-            raise StopIteration(self.resp_etag)
-        if len(self.buffer):
-            chunk = self.buffer[:PACKET_LENGTH]
-            self.buffer[:PACKET_LENGTH] = b''
-            self.received_length += len(chunk)
-            return bytes(chunk)
-        chunk = self.net.receive(PACKET_LENGTH)
+        remaining = self.content_length - self.received_length
+        if remaining == 0:  # file completed
+            self.finish(self.resp_etag)
+        if self.head == self.tail:
+            if self.net.state != 'CONNECTED':  # server closed the connection
+                self.keep_alive = False
+                self.finish(self.resp_etag)
+            self.head = 0
+            self.tail = self.net.receive_into(self.packet_view)
+            self.check_silence_timeout(self.tail == 0)
+        end = self.tail
+        if remaining > 0:
+            end = min(end, self.head + remaining)
+        chunk = self.view[self.head:end]
+        self.head = end
         self.received_length += len(chunk)
-        self.check_silence_timeout(len(chunk) == 0)
         return chunk
+
+    def check_connected(self):
+        if self.net.state != 'CONNECTED':
+            raise ValueError('Server closed connection before end of response')
+
+    # A chunked body is a series of chunks, each preceded by a line giving
+    # its length in hex and followed by CRLF.  A chunk of length zero and an
+    # optional list of trailer header lines end the body.
+    def chunk_size_read(self):
+        self.net.step()
+        crlf = self.find_crlf()
+        self.check_silence_timeout(crlf < 0)
+        if crlf > self.head:
+            end = self.buffer.find(b';', self.head, crlf)  # skip extensions
+            if end < 0:
+                end = crlf
+            self.chunk_length = int(bytes(self.view[self.head:end]), 16)
+            self.head = crlf + 2
+            if self.chunk_length:
+                self.read_body = self.chunk_data_read
+            else:
+                self.read_body = self.trailer_read
+        elif crlf == self.head:  # the CRLF at the end of the previous chunk
+            self.head = crlf + 2
+        else:
+            self.check_connected()
+            self.receive()
+
+    def chunk_data_read(self):
+        self.net.step()
+        if self.head == self.tail:
+            self.check_connected()
+            self.receive()
+            self.check_silence_timeout(self.head == self.tail)
+        end = min(self.tail, self.head + self.chunk_length)
+        chunk = self.view[self.head:end]
+        self.head = end
+        self.chunk_length -= len(chunk)
+        self.received_length += len(chunk)
+        if not self.chunk_length:
+            self.read_body = self.chunk_size_read
+        return chunk
+
+    def trailer_read(self):
+        self.net.step()
+        crlf = self.find_crlf()
+        self.check_silence_timeout(crlf < 0)
+        if crlf > self.head:
+            self.head = crlf + 2
+        elif crlf == self.head:
+            self.head = crlf + 2
+            self.finish(self.resp_etag)
+        else:
+            self.check_connected()
+            self.receive()
@@ -0,0 +1,166 @@
+"""An incremental JSON parser, for documents that arrive in pieces.
+
+Data is passed to Parser.feed() in pieces of any size, and Parser.finish()
+returns the parsed value.  A handler can take completed objects and arrays
+as soon as they have been parsed, so that they need not all be held in
+memory until the end.
+"""
+
+import json
+
+# Parser states, which indicate what the parser expects to see next.
+VALUE = 0  # any value
+OBJECT_START = 1  # a key, or the end of an empty object
+ARRAY_START = 2  # a value, or the end of an empty array
+KEY = 3  # a key
+COLON = 4  # the colon after a key
+NEXT = 5  # a comma, or the end of the current object or array
+
+QUOTE = 0x22  # "
+BACKSLASH = 0x5c  # \
+DELIMITERS = b' \t\r\n,:]}'
+
+
+class Parser:
+    def __init__(self, handler=None):
+        # handler(path, value) is called when each object or array has been
+        # parsed, with a list of the keys and indexes that lead to it from the
+        # root.  If it returns True, the value is not added to its parent.
+        self.handler = handler
+        self.buffer = bytearray()
+        self.stack = []  # objects and arrays under construction
+        self.path = []  # key or index of the next value in each of them
+        self.state = VALUE
+        self.result = None
+        self.done = False
+
+    def feed(self, data):
+        """Parses as much as possible of the data received so far."""
+        buffer = self.buffer
+        buffer.extend(data)
+        pos = self.parse(buffer, False)
+        buffer[:pos] = b''
+
+    def finish(self):
+        """Parses the rest of the data and returns the parsed value."""
+        buffer = self.buffer
+        pos = self.parse(buffer, True)
+        if not self.done or pos < len(buffer):
+            raise ValueError('Incomplete JSON document')
+        buffer[:] = b''
+        return self.result
+
+    def parse(self, buffer, final):
+        """Parses tokens from the buffer until it runs out of complete tokens,
+        and returns the position of the first unparsed byte."""
+        pos = 0
+        length = len(buffer)
+        while pos < length:
+            c = buffer[pos]
+            if c <= 0x20:  # whitespace
+                pos += 1
+                continue
+            if self.done:
+                raise ValueError(f'Extra data at {pos}')
+            state = self.state
+            if c == QUOTE:
+                end = find_string_end(buffer, pos)
+                if end < 0:
+                    break
+                text = decode_string(buffer, pos, end)
+                pos = end + 1
+                if state == KEY or state == OBJECT_START:
+                    self.path[-1] = text
+                    self.state = COLON
+                elif state == VALUE or state == ARRAY_START:
+                    self.add(text)
+                else:
+                    raise ValueError(f'Unexpected string at {pos}')
+            elif c == 0x3a:  # :
+                if state != COLON:
+                    raise ValueError(f'Unexpected colon at {pos}')
+                self.state = VALUE
+                pos += 1
+            elif c == 0x2c:  # ,
+                if state != NEXT:
+                    raise ValueError(f'Unexpected comma at {pos}')
+                self.state = KEY if isinstance(self.stack[-1], dict) else VALUE
+                pos += 1
+            elif c == 0x7b or c == 0x5b:  # { or [
+                if state != VALUE and state != ARRAY_START:
+                    raise ValueError(f'Unexpected {chr(c)} at {pos}')
+                if c == 0x7b:
+                    self.stack.append({})
+                    self.path.append(None)
+                    self.state = OBJECT_START
+                else:
+                    self.stack.append([])
+                    self.path.append(0)
+                    self.state = ARRAY_START
+                pos += 1
+            elif c == 0x7d or c == 0x5d:  # } or ]
+                value = self.stack[-1]
+                if not (state == NEXT or state == (
+                    OBJECT_START if c == 0x7d else ARRAY_START)) or (
+                    isinstance(value, dict) != (c == 0x7d)):
+                    raise ValueError(f'Unexpected {chr(c)} at {pos}')
+                self.stack.pop()
+                self.path.pop()
+                if self.handler and self.handler(self.path, value):
+                    self.skip()
+                else:
+                    self.add(value)
+                pos += 1
+            else:  # a number, true, false, or null
+                if state != VALUE and state != ARRAY_START:
+                    raise ValueError(f'Unexpected value at {pos}')
+                end = pos + 1
+                while end < length and buffer[end] not in DELIMITERS:
+                    end += 1
+                if end == length and not final:
+                    break
+                self.add(json.loads(str(buffer[pos:end], 'ascii')))
+                pos = end
+        return pos
+
+    def add(self, value):
+        """Adds a parsed value to the object or array that contains it."""
+        if self.stack:
+            parent = self.stack[-1]
+            if isinstance(parent, dict):
+                parent[self.path[-1]] = value
+            else:
+                parent.append(value)
+        else:
+            self.result = value
+        self.skip()
+
+    def skip(self):
+        """Moves on to the next value after one has been parsed."""
+        if self.stack:
+            if not isinstance(self.stack[-1], dict):
+                self.path[-1] += 1
+            self.state = NEXT
+        else:
+            self.done = True
+
+
+def find_string_end(buffer, pos):
+    """Finds the closing quotation mark of the string that starts at pos, or
+    returns -1 if the string isn't complete yet."""
+    end = pos
+    while True:
+        end = buffer.find(b'"', end + 1)
+        if end < 0:
+            return -1
+        i = end - 1
+        while buffer[i] == BACKSLASH:
+            i -= 1
+        if (end - i) % 2:  # preceded by an even number of backslashes
+            return end
+
+
+def decode_string(buffer, pos, end):
+    if buffer.find(b'\\', pos, end) < 0:
+        return str(buffer[pos + 1:end], 'utf-8')
+    return json.loads(str(buffer[pos:end + 1], 'utf-8'))
@@ -0,0 +1,91 @@
+"""Decides when to run the garbage collector.
+
+A full collection pauses everything for long enough to cause a visible
+hitch in scrolling text, so collections are run at the end of a frame,
+once enough has been allocated to be worth it and the frame has left
+enough time for one.  If allocation runs far ahead, or the free heap falls
+low enough that the allocator would soon collect anyway, a collection is
+run at the end of the frame regardless.
+"""
+
+import gc
+import time
+
+# A frame that finishes sooner than this leaves time for a collection.
+FRAME_MS = 33
+
+# Collect when a frame leaves time for it, once this many bytes have been
+# allocated since the last collection.
+ALLOC_BYTES = 8*1024
+
+# Collect at the end of any frame once this many bytes have been allocated
+# since the last collection, or once the free heap falls below LOW_FREE_BYTES.
+MAX_ALLOC_BYTES = 32*1024
+LOW_FREE_BYTES = 16*1024
+
+# Counters, for logging.
+collections = 0  # number of collections run by collect()
+total_pause_us = 0  # total time spent in collect()
+max_pause_us = 0  # longest time spent in collect()
+last_pause_us = 0  # time spent in the most recent collect()
+min_free = None  # least free heap seen just after a collection
+
+last_alloc = 0  # heap allocated just after the last collection
+frame_start_ns = 0
+
+
+# The simulator's gc module can't measure the heap.
+measurable = hasattr(gc, 'mem_free')
+
+
+def get_free():
+    return gc.mem_free() if measurable else 0
+
+
+def get_alloc():
+    return gc.mem_alloc() if measurable else 0
+
+
+def collect():
+    global collections
+    global total_pause_us
+    global max_pause_us
+    global last_pause_us
+    global min_free
+    global last_alloc
+    start_ns = time.monotonic_ns()
+    gc.collect()
+    pause_us = (time.monotonic_ns() - start_ns)//1000
+    collections += 1
+    total_pause_us += pause_us
+    max_pause_us = max(max_pause_us, pause_us)
+    last_pause_us = pause_us
+    free = get_free()
+    min_free = free if min_free is None else min(min_free, free)
+    last_alloc = get_alloc()
+
+
+def start_frame():
+    global frame_start_ns
+    frame_start_ns = time.monotonic_ns()
+
+
+def end_frame():  # called after the frame has been sent to the display
+    if not measurable:
+        return
+    allocated = get_alloc() - last_alloc
+    if allocated > ALLOC_BYTES:
+        elapsed_us = (time.monotonic_ns() - frame_start_ns)//1000
+        if FRAME_MS*1000 - elapsed_us > last_pause_us:
+            return collect()
+    if allocated > MAX_ALLOC_BYTES or get_free() < LOW_FREE_BYTES:
+        collect()
+
+
+def get_stats():
+    mean_us = total_pause_us//collections if collections else 0
+    return (f'{collections} GCs, {mean_us/1000:.1f} ms mean, ' +
+            f'{max_pause_us/1000:.1f} ms max, {min_free} min free')
+
+
+collect()
@@ -2,6 +2,7 @@ from ccinput import ButtonReader, DialReader, Press
 import cctime
 import display
 import fs
+import memory
 from microfont import small
 import os
 import prefs
@@ -10,8 +11,6 @@ import utils
 class MenuMode:
     def __init__(self, app, button_map, dial_map):
         self.app = app
-        self.pi = display.get_pi(0x80, 0x80, 0x80)
-        self.cursor_pi = display.get_pi(0x00, 0xff, 0x00)
         self.next_draw = cctime.monotonic_millis()
 
         self.reader = ButtonReader(button_map, {
@@ -118,7 +117,7 @@ class MenuMode:
                 (f'ESP firmware', self.app.net.firmware_version,
                     None, None, []),
                 (f'Free disk', lambda: f'{fs.free()//1000} kB', None, None, []),
-                (f'Free memory', utils.free, None, None, []),
+                (f'Free memory', memory.get_free, None, None, []),
                 (f'Uptime', self.app.frame_counter.uptime, None, None, []),
                 (f'Battery level', battery_level, None, None, []),
                 ('Back', None, 'BACK', None, [])
@@ -131,6 +130,8 @@ class MenuMode:
         self.top = self.index = self.offset = 0
 
     def start(self):
+        self.pi = display.get_pi(0x80, 0x80, 0x80, self)
+        self.cursor_pi = display.get_pi(0x00, 0xff, 0x00, self)
         self.reader.reset()
         self.dial_reader.reset()
         if self.app.net.state not in ['ONLINE', 'CONNECTED']:
@@ -192,7 +193,7 @@ class MenuMode:
         bitmap = self.app.bitmap
         level = self.app.battery_sensor.level
         if level is not None:
-            batt_pi = display.get_pi(0xff, 0, 0) if level < 10 else self.cursor_pi
+            batt_pi = display.get_pi(0xff, 0, 0, self) if level < 10 else self.cursor_pi
             bitmap.fill(self.pi, 1, 23, 23, 31)
             bitmap.fill(self.pi, 22, 25, 24, 29)
             bitmap.fill(0, 2, 24, 22, 30)
@@ -6,6 +6,10 @@ import sys
 large = None
 small = None
 
+# Glyphs for codepoints below this limit are found with a direct-mapped table;
+# the few glyphs above it (dashes, arrows, etc.) are found with a dict.
+TABLE_LIMIT = 0x400
+
 
 def init():
     global large
@@ -32,6 +36,8 @@ class Microfont:
     #   - The x-offset into the bitmap of each glyph
     #   - The x-offset of each glyph within its bounding box
     #   - The advance width of each glyph
+    # At load time, we build a table from codepoints to glyph indexes, so
+    # that each glyph can be found in constant time.
 
     def __init__(self, path):
         with fs.open(path) as file:
@@ -67,29 +73,60 @@ class Microfont:
             (self.w, self.h, self.bitmap, self.starts, self.stops, self.sxs,
                 self.dxs, self.cws) = w, h, bitmap, starts, stops, sxs, dxs, cws
 
+        table_len = 0
+        for i in range(num_ranges):
+            if starts[i] < TABLE_LIMIT:
+                table_len = min(stops[i], TABLE_LIMIT)
+        self.table = array('H', bytes(table_len * 2))
+        self.extra = {}
+        offset = 0
+        for i in range(num_ranges):
+            for c in range(starts[i], stops[i]):
+                if c < table_len:
+                    self.table[c] = offset + c - starts[i]
+                else:
+                    self.extra[c] = offset + c - starts[i]
+            offset += stops[i] - starts[i]
+
     def get_index(self, ch):
         c = ord(ch)
-        r, nr = 0, len(self.starts)
-        offset = 0
-        while r < nr:
-            start, stop = self.starts[r], self.stops[r]
-            if c >= start and c < stop:
-                return offset + c - start
-            offset += stop - start
-            r += 1
-        return 0
+        if c < len(self.table):
+            return self.table[c]
+        return self.extra.get(c, 0)
+
+    def fits(self, i):
+        # Returns True if glyph i lies entirely within its advance width.
+        return self.dxs[i] + self.sxs[i + 1] - self.sxs[i] <= self.cws[i]
+
+    def encode(self, text):
+        # Converts text to an array of glyph indexes, for use with
+        # measure_glyphs() and draw_glyphs() in frequently drawn text.
+        return array('H', [self.get_index(ch) for ch in text])
 
     def measure(self, text):
-        return sum(self.cws[self.get_index(ch)] for ch in text)
+        cws = self.cws
+        return sum(cws[self.get_index(ch)] for ch in text)
+
+    def measure_glyphs(self, glyphs):
+        cws = self.cws
+        return sum(cws[i] for i in glyphs)
 
     def draw(self, text, bitmap, x=0, y=0, pi=1):
         for ch in text:
-            i = self.get_index(ch)
-            bitmap.freeblit(
-                x + self.dxs[i], y,
-                self.bitmap,
-                self.sxs[i], 0, self.sxs[i + 1] - self.sxs[i], self.h,
-                source_bg=0, dest_value=pi
-            )
-            x += self.cws[i]
+            x = self.draw_glyph(self.get_index(ch), bitmap, x, y, pi)
         return x
+
+    def draw_glyphs(self, glyphs, bitmap, x=0, y=0, pi=1):
+        for i in glyphs:
+            x = self.draw_glyph(i, bitmap, x, y, pi)
+        return x
+
+    def draw_glyph(self, i, bitmap, x=0, y=0, pi=1):
+        sxs = self.sxs
+        bitmap.freeblit(
+            x + self.dxs[i], y,
+            self.bitmap,
+            sxs[i], 0, sxs[i + 1] - sxs[i], self.h,
+            source_bg=0, dest_value=pi
+        )
+        return x + self.cws[i]
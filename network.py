@@ -28,6 +28,7 @@ class Network:
         # Don't set esp._debug!  It causes UDP to stop working. :(
 
         self.socket = None
+        self.stream = None  # socket object for self.socket (see get_stream)
         self.set_state('OFFLINE')
         self.indicator = utils.null_context
 
@@ -100,6 +101,7 @@ class Network:
                 self.esp.socket_open(self.socket, host, port, mode)
                 if self.esp.socket_connected(self.socket):
                     self.set_state('CONNECTED')
+                    self.stream = self.get_stream()
             except Exception as e:
                 utils.report_error(e, 'Failed to open socket; resetting')
                 self.esp.reset()
@@ -120,6 +122,36 @@ class Network:
             print(f'Received {len(data)} bytes.')
         return data
 
+    # Wraps the open socket in a socket object, if socklib can do that and
+    # its sockets have recv_into(), so received data can go straight into
+    # the caller's buffer.
+    def get_stream(self):
+        try:
+            stream = self.socklib.socket(socknum=self.socket)
+        except TypeError:  # this socklib can't wrap an existing socket
+            return None
+        return stream if hasattr(stream, 'recv_into') else None
+
+    # Receives up to len(view) bytes into a writable memoryview, returning the
+    # number of bytes received.
+    def receive_into(self, view):
+        if not self.stream:  # fall back to receiving a copy
+            data = self.receive(len(view))
+            count = len(data)
+            view[:count] = data
+            return count
+        count = 0
+        if self.state == 'CONNECTED':
+            available = self.esp.socket_available(self.socket)
+            if available:
+                # Ask for no more than is available, so this doesn't block.
+                count = self.stream.recv_into(view, min(available, len(view)))
+                if count == 0:
+                    print('Server closed connection.')
+                    self.close()
+                print(f'Received {count} bytes.')
+        return count
+
     def close(self):
         if self.socket is not None:
             try:
@@ -128,4 +160,5 @@ class Network:
             except Exception as e:
                 utils.report_error(e, 'Failed to close socket')
         self.socket = None
+        self.stream = None
         self.set_state('ONLINE' if self.esp.status == 3 else 'OFFLINE')
@@ -1,6 +1,27 @@
+import cctime
 import fs
 import json
+from md5 import md5
 
+# Changes are not written immediately; they are collected until no more
+# have been made for SAVE_DELAY_MS, and then appended together as one line
+# per pref to JOURNAL_PATH.  When the journal grows past JOURNAL_LIMIT
+# bytes, it is folded into PREFS_PATH (see save()).  The journal begins with
+# the MD5 digest of the PREFS_PATH it was written against, so that a journal
+# is ignored if PREFS_PATH has since been replaced or edited by hand.
+PREFS_PATH = 'data/prefs.json'
+JOURNAL_PATH = 'data/prefs.log'
+JOURNAL_LIMIT = 4096
+SAVE_DELAY_MS = 2000
+
+# Code that reads a pref on every frame can subscribe to it instead, to be
+# called with its value once and then again whenever it changes.
+subscribers = {}  # {name: [callback, ...]}
+
+dirty = set()  # names of prefs changed since the last flush()
+changed_millis = 0  # monotonic time of the last change
+journal_length = 0
+prefs_digest = ''  # MD5 hex digest of the contents of PREFS_PATH
 
 pairs = {
     # User-editable settings
@@ -21,6 +42,7 @@ pairs = {
     'ntp_server': 'time.nist.gov',
     'colorspace': 'SRGB',
     'deadline_force_caps': True,
+    'newsfeed_speed': 40,
 }
 
 
@@ -30,12 +52,50 @@ def init():
     except Exception as e:
         print(f'Could not load /prefs.json: {e}')
     try:
-        pairs.update(json.load(fs.open('data/prefs.json')))
+        pairs.update(json.loads(read_prefs_file()))
     except Exception as e:
-        print(f'Could not load /data/prefs.json: {e}')
-    if not fs.isfile('data/prefs.json'):
+        print(f'Could not load /{PREFS_PATH}: {e}')
+    replay_journal()
+    if not fs.isfile(PREFS_PATH):
         print('Creating prefs.json.')
         save()
+    for name in subscribers:
+        notify(name)
+
+
+def read_prefs_file():
+    global prefs_digest
+    prefs_digest = ''
+    with fs.open(PREFS_PATH) as file:
+        data = file.read()
+    prefs_digest = md5(data).hexdigest()
+    return data
+
+
+def replay_journal():
+    global journal_length
+    journal_length = 0
+    if not fs.isfile(JOURNAL_PATH):
+        return
+    with fs.open(JOURNAL_PATH) as file:
+        data = file.read()
+    lines = data.split(b'\n')
+    if lines[0] != get_journal_header()[:-1]:
+        print(f'Ignoring /{JOURNAL_PATH}, which was written for another ' +
+              f'version of /{PREFS_PATH}.')
+        fs.destroy(JOURNAL_PATH)
+        return
+    journal_length = len(data)
+    for line in lines[1:]:
+        try:
+            name, value = json.loads(line)
+            pairs[name] = value
+        except Exception:  # a blank line or an incompletely written entry
+            pass
+
+
+def get_journal_header():
+    return (json.dumps(['@digest', prefs_digest]) + '\n').encode()
 
 
 def get(name, default=None):
@@ -43,21 +103,73 @@ def get(name, default=None):
 
 
 def get_int(name, default):
+    return to_int(pairs.get(name), default)
+
+
+def to_int(value, default):
     try:
-        return int(pairs.get(name))
+        return int(value)
     except:
         return default
 
 
+def subscribe(name, callback):
+    subscribers.setdefault(name, []).append(callback)
+    callback(pairs.get(name))
+
+
+def notify(name):
+    for callback in subscribers.get(name, []):
+        callback(pairs.get(name))
+
+
 def set(name, value):
+    global changed_millis
     if pairs.get(name) != value:
         pairs[name] = value
         print(f'Set pref: {name} = {repr(value)}')
+        dirty.add(name)
+        changed_millis = cctime.monotonic_millis()
+        notify(name)
+
+
+def step():  # called once per frame
+    if dirty and cctime.monotonic_millis() > changed_millis + SAVE_DELAY_MS:
+        flush()
+
+
+def flush():  # appends all unsaved changes to the journal
+    global journal_length
+    if not dirty:
+        return
+    data = ''.join(json.dumps([name, pairs.get(name)]) + '\n'
+                   for name in dirty).encode()
+    if not journal_length:
+        data = get_journal_header() + data
+    try:
+        fs.append(JOURNAL_PATH, data)
+        journal_length += len(data)
+    except Exception as e:
+        print(f'Could not write prefs.log: {e}')
+        if not save():
+            # The filesystem is probably read-only (e.g. the drive is
+            # mounted over USB), so retrying would only fail again.
+            print('Pref changes will not be saved.')
+            dirty.clear()
+        return
+    dirty.clear()
+    if journal_length > JOURNAL_LIMIT:
         save()
 
 
-def save():
+def save():  # rewrites prefs.json with all prefs, and empties the journal
+    global journal_length
     try:
-        fs.write_json('data/prefs.json', pairs)
+        fs.write_json(PREFS_PATH, pairs)
+        read_prefs_file()
+        dirty.clear()
+        fs.destroy(JOURNAL_PATH)
+        journal_length = 0
+        return True
     except Exception as e:
         print(f'Could not write prefs.json: {e}')
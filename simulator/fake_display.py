@@ -22,8 +22,10 @@ def init(bitmap):
     fake_display = FakeDisplay(
         bitmap, 20, display.BIT_DEPTH,
         scale=args.scale, left=args.left, top=args.top)
+    display.bitmap = bitmap
     display.shader = [0]*bitmap.depth
     display.send = fake_display.send
+    display.idle = fake_display.idle
 
 
 def linear_to_srgb(v):
@@ -111,3 +113,8 @@ class FakeDisplay:
         time.sleep(1.0/self.fps)
         SDL_UpdateWindowSurface(self.window)
         self.flush_events()
+
+    def idle(self):
+        # Nothing to redraw, but keep the frame rate and inputs realistic.
+        time.sleep(1.0/self.fps)
+        self.flush_events()
@@ -1,11 +1,14 @@
 import fs
+import json
 from md5 import md5
 from utils import to_str
 
 
 MAX_PACK_FORMAT_VERSION = 1
 
-# To limit memory use, we extend the unpacking buffer this much at a time.
+# Blocks other than file chunks, and block headers split across network
+# reads, are gathered in a buffer of this length.  File chunks are hashed
+# and written straight from the data returned by the stream.
 MAX_CHUNK_LENGTH = 1024
 
 # For safety, we set an upper limit on the total size of the unpacked
@@ -14,12 +17,26 @@ DISK_CAPACITY = 2*1024*1024  # total flash disk space available
 MAX_ROOT_SIZE = 512*1024  # max allotted for root files and lib/ directory
 MAX_UNPACKED_SIZE = (DISK_CAPACITY - MAX_ROOT_SIZE) / 4
 
+# When a download fails, the unpacking state is saved in this file inside the
+# pack directory, so the next attempt can resume where this one left off.
+RESUME_FILE = '@RESUME'
+
 
 class Unpacker:
-    def __init__(self, stream):
+    def __init__(self, stream, quiet=False):
         self.stream = stream
+        self.quiet = quiet  # if True, don't log every block
+        self.buffer = bytearray(MAX_CHUNK_LENGTH)
+        self.view = memoryview(self.buffer)
+        self.length = 0  # number of bytes gathered in self.buffer
+        self.data = b''  # the data most recently read from the stream
+        self.pos = 0  # position of the next unused byte in self.data
+        self.reset()
 
-        self.buffer = bytearray()
+    def reset(self):
+        self.offset = 0  # position in the pack of the next unused byte
+        self.resumable = True
+        self.file_names = []
         self.unpacked_size = 0
         self.block_type = b''
         self.block_length = 0
@@ -27,61 +44,186 @@ class Unpacker:
         self.pack_hash = b''
         self.dir_name = b''
         self.file_path = b''
+        self.file = fs.Appender(None, MAX_CHUNK_LENGTH*4)
         self.digest = md5()
-        self.step = self.magic_step
+        self.state = self.magic_step
+
+    def resume(self, dir_name):
+        """Restores the state saved by save(), if any, for the pack that will
+        be unpacked into dir_name.  Returns the offset to resume from."""
+        try:
+            with fs.open(dir_name + '/' + RESUME_FILE, 'rt') as file:
+                state = json.load(file)
+            # The files will grow past this state as soon as unpacking
+            # resumes, so the state must not be used again unless save()
+            # writes it afresh (e.g. after a power loss, it must not be).
+            fs.destroy(dir_name + '/' + RESUME_FILE)
+            for name in state['file_names']:
+                self.digest.update(name.encode())
+                self.update_digest_from_file(dir_name + '/' + name)
+        except Exception as e:
+            print(f'Not resuming {dir_name}: {e}')
+            self.digest = md5()
+            return 0
+        self.offset = state['offset']
+        self.block_type = state['block_type'].encode()
+        self.block_length = state['block_length']
+        self.pack_name = state['pack_name']
+        self.pack_hash = state['pack_hash']
+        self.dir_name = dir_name
+        self.file_names = state['file_names']
+        if self.file_names:
+            self.file_path = dir_name + '/' + self.file_names[-1]
+            self.file.path = self.file_path
+        self.unpacked_size = state['unpacked_size']
+        self.state = self.resume_step
+        print(f'Resuming {dir_name} from offset {self.offset}')
+        return self.offset
+
+    def update_digest_from_file(self, path):
+        if not fs.isfile(path):  # no chunks of this file had arrived yet
+            return
+        with fs.open(path) as file:
+            while True:
+                count = file.readinto(self.buffer)
+                if not count:
+                    break
+                self.digest.update(self.view[:count])
+
+    def close(self):
+        """Writes out any buffered file content and closes the file."""
+        self.file.close()
+
+    def save(self):
+        """Saves the unpacking state so that resume() can pick it up."""
+        try:
+            self.close()
+        except Exception:
+            # Buffered file content was lost, so this state is not valid.
+            self.resumable = False
+            raise
+        if self.resumable and self.dir_name and self.offset:
+            fs.write_json(self.dir_name + '/' + RESUME_FILE, {
+                'offset': self.offset,
+                'block_type': to_str(self.block_type),
+                'block_length': self.block_length,
+                'pack_name': self.pack_name,
+                'pack_hash': self.pack_hash,
+                'file_names': self.file_names,
+                'unpacked_size': self.unpacked_size,
+            })
+            print(f'Saved state of {self.dir_name} at offset {self.offset}')
 
-    def extend_buffer(self, target_length):
-        if len(self.buffer) < target_length:
-            count = max(MAX_CHUNK_LENGTH, target_length - len(self.buffer))
-            self.buffer.extend(self.stream.read() or b'')
-        return len(self.buffer) >= target_length
+    def step(self):
+        """Unpacks as much of the pack as has arrived.  Returns True when the
+        pack has been completely unpacked."""
+        if self.pos == len(self.data):
+            self.data = self.stream.read() or b''
+            self.pos = 0
+        while True:
+            # Each state returns False if it made progress and can continue,
+            # None if it needs more data, or True if unpacking is complete.
+            result = self.state()
+            if result is not False:
+                return result
+
+    def take(self, length):
+        """Returns a view of the next length bytes of the pack, or None if
+        they have not all arrived yet.  Bytes that arrive in one piece are
+        returned in place; otherwise they are gathered in self.buffer."""
+        if length > len(self.buffer):
+            raise ValueError(f'Block of {length} bytes is too long')
+        available = len(self.data) - self.pos
+        if not self.length and available >= length:
+            return self.take_some(length)
+        count = min(available, length - self.length)
+        self.buffer[self.length:self.length + count] = (
+            self.data[self.pos:self.pos + count])
+        self.pos += count
+        self.length += count
+        if self.length < length:
+            return None
+        self.length = 0
+        self.offset += length
+        return self.view[:length]
+
+    def take_some(self, limit):
+        """Returns a view of up to limit bytes of the data that has arrived."""
+        start = self.pos
+        self.pos = min(len(self.data), start + limit)
+        self.offset += self.pos - start
+        return memoryview(self.data)[start:self.pos]
+
+    def resume_step(self):
+        """Checks that the server honoured the request to resume."""
+        if self.pos == len(self.data):
+            return
+        if self.stream.status != b'206':
+            print(f'Server sent the whole pack; starting over.')
+            self.reset()
+            return False
+        if self.block_length:
+            self.state = self.block_content_step
+        else:
+            self.state = self.block_header_step
+        return False
 
     def magic_step(self):
         """Reads and verifies the first 4 bytes of the pack file."""
-        if not self.extend_buffer(4):
+        header = self.take(4)
+        if not header:
             return
-        magic = self.buffer[:2]
+        magic = bytes(header[:2])
         if magic != b'pk':
-            raise ValueError(f'Invalid magic {bytes(magic)}')
-        version = (self.buffer[2] << 8) + self.buffer[3]
+            raise ValueError(f'Invalid magic {magic}')
+        version = (header[2] << 8) + header[3]
         if version > MAX_PACK_FORMAT_VERSION:
             raise ValueError(f'Unsupported version {version}')
         print(f'Receiving pack version {version}')
-        self.buffer[:4] = b''
-        self.step = self.block_header_step
-        return self.step()
+        self.state = self.block_header_step
+        return False
 
     def block_header_step(self):
         """Reads the 4-byte header of a block."""
-        if not self.extend_buffer(4):
+        header = self.take(4)
+        if not header:
             return
-        self.block_type = self.buffer[:2]
-        self.block_length = (self.buffer[2] << 8) + self.buffer[3]
-        self.buffer[:4] = b''
-        self.step = self.block_content_step
-        return self.step()
+        self.block_type = bytes(header[:2])
+        self.block_length = (header[2] << 8) + header[3]
+        self.state = self.block_content_step
+        return False
 
     def block_content_step(self):
-        """Reads a block, splitting long blocks into chunks. """
-        chunk_length = min(MAX_CHUNK_LENGTH, self.block_length)
-        if not self.extend_buffer(chunk_length):
-            return
-        content = self.buffer[:chunk_length]
-        self.buffer[:chunk_length] = b''
+        """Reads a block.  File chunks are handled in whatever pieces they
+        arrive in; other blocks are handled whole."""
+        if self.block_type == b'fc':
+            content = self.take_some(self.block_length)
+            if self.block_length and not content:
+                return
+        else:
+            content = self.take(self.block_length)
+            if content is None:
+                return
+        # If handle_block fails partway, the files on disk may not match the
+        # unpacking state, so it is not safe to resume from this state.
+        self.resumable = False
         done = self.handle_block(self.block_type, content)
         if done:
             return True
-        self.block_length -= chunk_length
+        self.block_length -= len(content)
+        self.resumable = True
         if self.block_length == 0:
-            self.step = self.block_header_step
-            return self.step()
+            self.state = self.block_header_step
+        return False
 
     def handle_block(self, block_type, content):
         """Handles a block according to its type."""
-        content = bytes(content)
-        print(
-            f'Received {bytes(block_type)} block ' +
-            f'{len(content) < 20 and content or "(%d bytes)" % len(content)}')
+        if block_type != b'fc':
+            content = bytes(content)
+        if not self.quiet:
+            print(f'Received {block_type} block ' + (
+                f'{bytes(content)}' if len(content) < 20 else
+                f'({len(content)} bytes)'))
 
         if block_type == b'pn':  # pack name
             self.pack_name = to_str(content).replace('/', '')
@@ -98,7 +240,10 @@ class Unpacker:
                     fs.destroy(self.dir_name)
 
         if block_type == b'fn':  # file name
+            self.file_names.append(to_str(content))
             self.file_path = self.dir_name + '/' + to_str(content)
+            self.file.close()
+            self.file.path = self.file_path
             self.digest.update(content)
 
         if block_type == b'fc':  # file chunk
@@ -107,14 +252,19 @@ class Unpacker:
                 raise ValueError(
                     f'Pack exceeded limit of {MAX_UNPACKED_SIZE} bytes.')
             self.digest.update(content)
-            fs.append(self.file_path, content)
+            self.file.write(content)
 
         if block_type == b'pe':  # pack end
+            self.close()
             actual_hash = self.digest.hexdigest()
             if actual_hash == self.pack_hash:
+                fs.destroy(self.dir_name + '/' + RESUME_FILE)
                 fs.append(self.dir_name + '/@VALID', b'1')
                 print(f'Pack {self.dir_name} unpacked successfully!')
                 return True
+            # Start from scratch next time, in case a resumed download
+            # was spliced together wrongly.
+            fs.destroy(self.dir_name)
             raise ValueError(
                 f'Bad MD5 hash {actual_hash}; expected {self.pack_hash}')
 
@@ -1,7 +1,10 @@
+import ccapi
 import cctime
+import defn_cache
 import fs
 import json
 from http_fetcher import HttpFetcher
+import memory
 import microcontroller
 import os
 import prefs
@@ -25,6 +28,7 @@ class SoftwareUpdater:
 
         self.api_url = prefs.get('api_url')
         self.api_fetched = None
+        self.api_file = None
 
         self.update_url = prefs.get('update_url')
         self.index_file = None
@@ -33,6 +37,7 @@ class SoftwareUpdater:
         self.index_fetched = None
         self.index_packs = None
         self.unpacker = None
+        self.api_loader = None
 
         self.retry_after(INITIAL_DELAY)
 
@@ -63,60 +68,92 @@ class SoftwareUpdater:
             self.fetcher.go(
                 self.api_url.replace('.json', f'.{self.lang}.json') +
                 f'?p=ac&mac={self.net.mac_address}&up={fc.uptime()}' +
-                f'&mem={utils.min_mem}&disk={fs.free()}&fps={fc.fps:.1f}' +
+                f'&mem={memory.min_free}&disk={fs.free()}&fps={fc.fps:.1f}' +
                 f'&v={v}&vp={vp}&fv={fv}&t={now}&af={afetch}&if={ifetch}',
                 prefs.get(f'api_etag_{self.lang}'))
             self.step = self.api_fetch_step
-            fs.destroy(f'data/clock.{self.lang}.json.new')
+            filename = f'data/clock.{self.lang}.json'
+            fs.destroy(filename + '.new')
+            self.api_file = fs.Appender(filename + '.new')
+            # The body is parsed as it arrives, which both validates it and
+            # gets the definition ready without reading the file back.
+            items_path = ccapi.get_items_path(filename)
+            self.api_loader = ccapi.Loader(
+                None, items_path, items_path + '.fetch')
 
     def api_fetch_step(self):
-        received_new_file = False
+        defn = None
+        etag = None
         error = None
         filename = f'data/clock.{self.lang}.json'
         try:
-            fs.append(filename + '.new', self.fetcher.read())
+            data = self.fetcher.read()
+            if data:
+                self.api_file.write(data)
+                self.api_loader.feed(data)
             return
         except StopIteration as stop:
-            self.net.close()
             if stop.value == 304:  # 304 means Not Modified
                 utils.log(f'API file unchanged (status 304)')
             else:
                 try:
-                    with fs.open(filename + '.new') as api_file:
-                        json.load(api_file)
+                    self.api_file.close()
+                    # The cache refers to the item file that finish() will
+                    # replace, so it must not outlive it.
+                    fs.destroy(defn_cache.get_path(filename))
+                    defn = self.api_loader.finish()
                     utils.log(f'API file successfully fetched')
-                    received_new_file = True
-                    prefs.set(f'api_etag_{self.lang}', stop.value or '')
+                    etag = stop.value or ''
+                    prefs.set(f'api_etag_{self.lang}', etag)
                 except Exception as e:
                     error = e
         except Exception as e:
             self.net.close()
             error = e
 
+        try:
+            self.api_file.close()
+        except Exception as e:
+            utils.report_error(e, 'Could not write API file')
+        self.api_file = None
+        if not defn:
+            self.api_loader.close()
         if error:
             utils.report_error(error, 'API fetch failed')
         else:
             self.api_fetched = cctime.get_millis()
 
-        if received_new_file:
+        self.api_loader = None
+        if defn:
             fs.move(filename + '.new', filename)
-            self.clock_mode.load_definition()
+            if etag:
+                try:
+                    defn_cache.save(filename, etag, defn)
+                except Exception as e:
+                    utils.report_error(e, 'Could not save definition cache')
+            if prefs.get('lang', 'en') == self.lang:
+                self.clock_mode.load_definition(defn)
 
         self.fetcher.go(self.update_url)
         self.step = self.index_fetch_step
         fs.destroy('data/packs.json')
+        self.index_file = fs.Appender('data/packs.json')
 
     def index_fetch_step(self):
         try:
-            fs.append('data/packs.json', self.fetcher.read())
+            self.index_file.write(self.fetcher.read() or b'')
             return
         except Exception as e:
-            self.net.close()
             if self.index_file:
-                self.index_file.close()
+                try:
+                    self.index_file.close()
+                except Exception as close_error:
+                    if isinstance(e, StopIteration):
+                        e = close_error  # the index file is incomplete
                 self.index_file = None
 
             if not isinstance(e, StopIteration):
+                self.net.close()
                 utils.report_error(e, 'Index fetch aborted')
                 self.retry_after(FAILURE_DELAY)
                 return
@@ -142,8 +179,9 @@ class SoftwareUpdater:
                 print(f'{dir_name} already exists and is valid')
                 self.finish_update()
             else:
-                self.fetcher.go(url)
-                self.unpacker = Unpacker(self.fetcher)
+                self.unpacker = Unpacker(self.fetcher, quiet=True)
+                start = self.unpacker.resume(dir_name)
+                self.fetcher.go(url, start=start)
                 self.step = self.pack_fetch_step
         else:
             print(f'No enabled versions found')
@@ -154,6 +192,10 @@ class SoftwareUpdater:
             done = self.unpacker.step()
         except Exception as e:
             utils.report_error(e, 'Pack fetch aborted')
+            try:
+                self.unpacker.save()
+            except Exception as e:
+                utils.report_error(e, 'Could not save unpacking state')
             self.retry_after(FAILURE_DELAY)
         else:
             if done:
@@ -167,6 +209,7 @@ class SoftwareUpdater:
             # repeatedly downgrade and upgrade; this is a safeguard to ensure
             # the clock still runs for at least MIN_RESTART_UPTIME.
             if self.app.frame_counter.uptime()*1000 > MIN_RESTART_UPTIME:
+                prefs.flush()
                 microcontroller.reset()
             else:
                 utils.log(f'New version v{latest_num} is ready to run')
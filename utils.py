@@ -1,4 +1,4 @@
-import gc
+import memory
 import microcontroller
 import micropython
 import re
@@ -18,16 +18,6 @@ def shut_down(battery_sensor):
             microcontroller.reset()
 
 
-def free():
-    return 0
-
-
-if hasattr(gc, 'mem_free'):
-    def free():
-        gc.collect()
-        return gc.mem_free()
-
-
 def version_num():
     return int(sys.path[0][1:].split('.')[0].split('-')[0])
 
@@ -50,17 +40,14 @@ def versions_present():
 
 last_ms = None
 last_mem = None
-min_mem = free()
 
 
 def log(message=None, dump=False):
     global last_ms
     global last_mem
-    global min_mem
     import time
     ms = time.monotonic_ns()//1000000
-    mem = free()
-    min_mem = min(min_mem, mem)
+    mem = memory.get_free()
     if message:
         msg = f'[{format_ms(ms)}: {mem} free] {message}'
         if last_ms:
@@ -73,7 +60,7 @@ def log(message=None, dump=False):
         last_ms = ms
         last_mem = mem
     if dump or debug:
-        gc.collect()
+        memory.collect()
         micropython.mem_info(1)
         print()
 